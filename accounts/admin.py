@@ -2,11 +2,16 @@ from django import forms
 from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as _UserAdmin
 from django.contrib.auth.forms import UsernameField
+from django.http import HttpResponseRedirect
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
 from django.utils.translation import gettext
 from django.utils.translation import gettext_lazy as _
 
-from .models import TrafficPolicy, User
-from .services import reset_users_data_usage
+from .models import BulkJob, EmailOutboxItem, QuotaAlert, TrafficPolicy, TrafficResetRun, User
+from .usage import get_daily_usage
+from .utils import prettify_bytes
 
 
 class UserCreationForm(forms.ModelForm):
@@ -28,11 +33,43 @@ class UserCreationForm(forms.ModelForm):
         return user
 
 
+class UsagePercentFilter(admin.SimpleListFilter):
+    title = _("usage")
+    parameter_name = 'usage'
+
+    def lookups(self, request, model_admin):
+        return [
+            ('90', _("Over 90% of quota")),
+            ('100', _("Quota exhausted")),
+            ('unknown', _("Unknown")),
+        ]
+
+    def queryset(self, request, queryset):
+        if self.value() in ('90', '100'):
+            return queryset.filter(xray_usage__usage_percent__gte=int(self.value()))
+        if self.value() == 'unknown':
+            return queryset.filter(xray_usage__isnull=True)
+        return queryset
+
+
 @admin.register(User)
 class UserAdmin(_UserAdmin):
     ordering = ['email']
-    list_display = ('email', 'username', 'is_active', 'is_staff', 'traffic_policy')
+    list_display = (
+        'email',
+        'username',
+        'is_active',
+        'is_staff',
+        'traffic_policy',
+        'used_traffic',
+        'traffic_limit',
+        'usage_percent',
+        'xray_status',
+    )
     list_editable = ['traffic_policy']
+    # Usage columns come from the local `XrayUsage` table, not from Marzban.
+    list_select_related = ['traffic_policy', 'xray_usage']
+    list_filter = _UserAdmin.list_filter + (UsagePercentFilter, 'xray_usage__status')
     search_fields = ('email', 'first_name', 'last_name')
     list_display_links = ['email']
 
@@ -52,7 +89,9 @@ class UserAdmin(_UserAdmin):
             },
         ),
         (_("Important dates"), {"fields": ("last_login", "date_joined")}),
+        (_("Usage"), {"fields": ("usage_history",)}),
     )
+    readonly_fields = ['usage_history']
 
     add_fieldsets = (
         (
@@ -64,15 +103,89 @@ class UserAdmin(_UserAdmin):
         ),
     )
 
-    actions = ["action_reset_usage"]
+    actions = [
+        "action_reset_usage",
+        "action_activate",
+        "action_deactivate",
+        "action_sync_limit",
+        "action_rotate_credentials",
+    ]
 
     add_form = UserCreationForm
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == 'traffic_policy':
+            # The changelist renders one select per row; list the policies once per request.
+            if not hasattr(request, '_traffic_policy_choices'):
+                request._traffic_policy_choices = list(formfield.choices)
+            formfield.choices = request._traffic_policy_choices
+        return formfield
+
+    @admin.display(description=_("Daily usage"))
+    def usage_history(self, obj: User) -> str:
+        if obj.pk is None:
+            return "-"
+        usage = reversed(get_daily_usage(obj.pk))
+        rows = format_html_join(
+            '', '<tr><td>{}</td><td>{}</td></tr>', ((day, prettify_bytes(traffic)) for day, traffic in usage)
+        )
+        return format_html('<table><tr><th>{}</th><th>{}</th></tr>{}</table>', _("Day"), _("Usage"), rows)
+
+    @admin.display(description=_("Used traffic"), ordering='xray_usage__used_traffic')
+    def used_traffic(self, obj: User) -> str:
+        usage = getattr(obj, 'xray_usage', None)
+        return prettify_bytes(usage.used_traffic) if usage else "-"
+
+    @admin.display(description=_("Traffic limit"), ordering='xray_usage__traffic_limit')
+    def traffic_limit(self, obj: User) -> str:
+        usage = getattr(obj, 'xray_usage', None)
+        return prettify_bytes(usage.traffic_limit) if usage and usage.traffic_limit else "-"
+
+    @admin.display(description=_("Usage"), ordering='xray_usage__usage_percent')
+    def usage_percent(self, obj: User) -> str:
+        usage = getattr(obj, 'xray_usage', None)
+        return f"{usage.usage_percent:.1f}%" if usage and usage.usage_percent is not None else "-"
+
+    @admin.display(description=_("Marzban status"), ordering='xray_usage__status')
+    def xray_status(self, obj: User) -> str:
+        usage = getattr(obj, 'xray_usage', None)
+        return usage.status if usage else "-"
+
+    def enqueue_bulk_job(self, request, queryset, kind: BulkJob.Kind) -> HttpResponseRedirect:
+        """
+        Queue `kind` for the selected users and show the job's progress page; the work
+        runs in the background instead of blocking this request.
+        """
+        user_ids = list(queryset.values_list('pk', flat=True))
+        job = BulkJob.objects.create(kind=kind, params={'user_ids': user_ids}, created_by=request.user)
+        self.message_user(
+            request,
+            gettext("%(job)s queued for %(count)d users.")
+            % {'job': job.get_kind_display(), 'count': len(user_ids)},
+            messages.INFO,
+        )
+        return redirect('admin:accounts_bulkjob_change', job.pk)
+
     @admin.action(description="Reset Traffic Usage")
-    def action_reset_usage(self, request, queryset) -> None:
-        users = list(queryset)
-        reset_users_data_usage(users=users)
-        self.message_user(request, gettext("Data usage reset for selected users."), messages.SUCCESS)
+    def action_reset_usage(self, request, queryset) -> HttpResponseRedirect:
+        return self.enqueue_bulk_job(request, queryset, BulkJob.Kind.RESET_USAGE)
+
+    @admin.action(description=_("Activate selected users"))
+    def action_activate(self, request, queryset) -> HttpResponseRedirect:
+        return self.enqueue_bulk_job(request, queryset, BulkJob.Kind.ACTIVATE)
+
+    @admin.action(description=_("Deactivate selected users"))
+    def action_deactivate(self, request, queryset) -> HttpResponseRedirect:
+        return self.enqueue_bulk_job(request, queryset, BulkJob.Kind.DEACTIVATE)
+
+    @admin.action(description=_("Sync traffic limit to Marzban"))
+    def action_sync_limit(self, request, queryset) -> HttpResponseRedirect:
+        return self.enqueue_bulk_job(request, queryset, BulkJob.Kind.SYNC_LIMIT)
+
+    @admin.action(description=_("Rotate credentials"))
+    def action_rotate_credentials(self, request, queryset) -> HttpResponseRedirect:
+        return self.enqueue_bulk_job(request, queryset, BulkJob.Kind.ROTATE_CREDENTIALS)
 
 
 class UserInline(admin.StackedInline):
@@ -92,7 +205,138 @@ class UserInline(admin.StackedInline):
         return False
 
 
+def message_bulk_job(model_admin: admin.ModelAdmin, request, job: BulkJob, message: str) -> None:
+    url = reverse('admin:accounts_bulkjob_change', args=[job.pk])
+    model_admin.message_user(request, format_html('{} <a href="{}">{}</a>', message, url, job), messages.INFO)
+
+
 @admin.register(TrafficPolicy)
 class TrafficPolicyAdmin(admin.ModelAdmin):
-    fields = ['name', 'quota']
+    fields = ['name', 'quota', 'alert_thresholds']
     inlines = [UserInline]
+
+    def save_model(self, request, obj, form, change) -> None:
+        super().save_model(request, obj, form, change)
+        if obj.sync_job:
+            obj.sync_job.created_by = request.user
+            obj.sync_job.save(update_fields=['created_by'])
+            message = gettext("Quota is being pushed to users in background.")
+            message_bulk_job(self, request, obj.sync_job, message)
+
+
+@admin.register(BulkJob)
+class BulkJobAdmin(admin.ModelAdmin):
+    list_display = (
+        'id',
+        'kind',
+        'status',
+        'progress_display',
+        'failed',
+        'created_by',
+        'created_at',
+        'finished_at',
+    )
+    list_filter = ('kind', 'status')
+    fields = [
+        'kind',
+        'status',
+        'params',
+        'progress_display',
+        'total',
+        'processed',
+        'failed',
+        'errors_display',
+        'created_by',
+        'created_at',
+        'started_at',
+        'finished_at',
+    ]
+    readonly_fields = fields
+    # Reloads the change page while the job is pending or running.
+    change_form_template = 'admin/accounts/bulkjob/change_form.html'
+
+    @admin.display(description=_("Errors"))
+    def errors_display(self, obj: BulkJob) -> str:
+        if not obj.errors:
+            return "-"
+        rows = format_html_join('', '<tr><td>{}</td><td>{}</td></tr>', sorted(obj.errors.items()))
+        return format_html('<table><tr><th>{}</th><th>{}</th></tr>{}</table>', _("User"), _("Error"), rows)
+
+    @admin.display(description=_("Progress"))
+    def progress_display(self, obj: BulkJob) -> str:
+        if obj.progress is None:
+            return "-"
+        return f"{obj.progress:.1f}%"
+
+    def has_add_permission(self, *args, **kwargs) -> bool:
+        return False
+
+    def has_change_permission(self, *args, **kwargs) -> bool:
+        return False
+
+
+@admin.register(QuotaAlert)
+class QuotaAlertAdmin(admin.ModelAdmin):
+    list_display = ('user', 'period', 'threshold', 'usage_percent', 'created_at', 'sent_at')
+    list_filter = ('period', 'threshold')
+    list_select_related = ['user']
+    search_fields = ('user__email', 'user__username')
+
+    def has_add_permission(self, *args, **kwargs) -> bool:
+        return False
+
+    def has_change_permission(self, *args, **kwargs) -> bool:
+        return False
+
+
+@admin.register(EmailOutboxItem)
+class EmailOutboxItemAdmin(admin.ModelAdmin):
+    list_display = (
+        'subject',
+        'recipients',
+        'priority',
+        'created_at',
+        'expires_at',
+        'attempts',
+        'next_attempt_at',
+        'last_error',
+    )
+    list_filter = ('priority', 'attempts')
+
+    def has_add_permission(self, *args, **kwargs) -> bool:
+        return False
+
+    def has_change_permission(self, *args, **kwargs) -> bool:
+        return False
+
+
+@admin.register(TrafficResetRun)
+class TrafficResetRunAdmin(admin.ModelAdmin):
+    list_display = (
+        'period',
+        'started_at',
+        'duration_display',
+        'users_reset',
+        'users_failed',
+        'throughput_display',
+        'completed',
+    )
+    list_filter = ('completed',)
+
+    @admin.display(description=_("Duration"))
+    def duration_display(self, obj: TrafficResetRun) -> str:
+        if obj.duration_seconds is None:
+            return "-"
+        return f"{obj.duration_seconds:.1f}s"
+
+    @admin.display(description=_("Throughput"))
+    def throughput_display(self, obj: TrafficResetRun) -> str:
+        if obj.throughput is None:
+            return "-"
+        return f"{obj.throughput:.1f} users/s"
+
+    def has_add_permission(self, *args, **kwargs) -> bool:
+        return False
+
+    def has_change_permission(self, *args, **kwargs) -> bool:
+        return False
@@ -0,0 +1,119 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q, QuerySet
+from django.utils import timezone
+
+from .models import QuotaAlert, TrafficPolicy, TrafficResetLog, TrafficResetRun, User, parse_alert_thresholds
+from .scheduling import get_period_start
+from .services import send_quota_alert_message
+
+logger = logging.getLogger(__name__)
+
+
+def get_alert_thresholds() -> dict[int | None, list[int]]:
+    """Thresholds per traffic policy id; None stands for users without a policy."""
+    thresholds = {
+        policy_id: parse_alert_thresholds(value)
+        for policy_id, value in TrafficPolicy.objects.values_list('pk', 'alert_thresholds')
+    }
+    thresholds[None] = parse_alert_thresholds(settings.QUOTA_ALERT_THRESHOLDS)
+    return thresholds
+
+
+def get_alertable_users(period: datetime) -> QuerySet | None:
+    """
+    Active users whose stored usage belongs to `period`: it was refreshed after the
+    period's last reset run, and the user was reset in it or joined after it started.
+
+    Until a run finishes (one was interrupted, or the logs predate the runs) this falls
+    back to the users with a reset log for `period` whose usage was refreshed after the
+    last run started, or after the period started when there is none. None while no user
+    was reset in `period` yet.
+    """
+    was_reset = TrafficResetLog.objects.filter(user=OuterRef('pk'), date=period)
+    run = (
+        TrafficResetRun.objects.filter(period=period, finished_at__isnull=False)
+        .order_by('-finished_at')
+        .first()
+    )
+    if run is not None:
+        return User.objects.filter(is_active=True, xray_usage__updated_at__gte=run.finished_at).filter(
+            Exists(was_reset) | Q(date_joined__gte=run.started_at)
+        )
+
+    if not TrafficResetLog.objects.filter(date=period).exists():
+        return None
+    started_at = (
+        TrafficResetRun.objects.filter(period=period)
+        .order_by('-started_at')
+        .values_list('started_at', flat=True)
+        .first()
+    )
+    logger.info("no finished usage reset run for %s, using its reset logs", period.date())
+    return User.objects.filter(
+        Exists(was_reset), is_active=True, xray_usage__updated_at__gte=started_at or period
+    )
+
+
+def evaluate_quota_alerts() -> int:
+    """
+    Record the quota thresholds users crossed in the current Persian month and email
+    them, once per threshold and period.
+
+    Usage is read from the local `XrayUsage` table with one query per policy and
+    threshold, so no Marzban call is made. A user crossing several thresholds at once
+    gets a single email for the highest one. Returns the number of emails queued.
+    """
+    period = get_period_start(timezone.now())
+    users = get_alertable_users(period)
+    if users is None:
+        logger.info("usage of %s is not reset yet, skipping quota alerts", period.date())
+        return 0
+
+    alert_list = []
+    for policy_id, thresholds in get_alert_thresholds().items():
+        policy_users = users.filter(traffic_policy_id=policy_id)
+        for threshold in thresholds:
+            alerted = QuotaAlert.objects.filter(user=OuterRef('pk'), period=period, threshold=threshold)
+            crossed = policy_users.filter(xray_usage__usage_percent__gte=threshold).filter(~Exists(alerted))
+            alert_list += [
+                QuotaAlert(user_id=user_id, period=period, threshold=threshold, usage_percent=usage_percent)
+                for user_id, usage_percent in crossed.values_list('pk', 'xray_usage__usage_percent')
+            ]
+    QuotaAlert.objects.bulk_create(alert_list, ignore_conflicts=True)
+    return send_quota_alerts(period)
+
+
+def send_quota_alerts(period: datetime) -> int:
+    pending = defaultdict(list)
+    # The usage row of a user missing from the snapshot is dropped after a while; their
+    # alerts wait until it is back instead of failing the whole run.
+    unsent = QuotaAlert.objects.filter(
+        period=period, sent_at__isnull=True, user__xray_usage__isnull=False
+    ).select_related('user__xray_usage')
+    for alert in unsent:
+        pending[alert.user].append(alert)
+
+    sent = 0
+    for user, alerts in pending.items():
+        usage = user.xray_usage
+        try:
+            send_quota_alert_message(
+                user=user,
+                usage_percent=max(alert.usage_percent for alert in alerts),
+                used_traffic=usage.used_traffic,
+                traffic_limit=usage.traffic_limit,
+            )
+        except Exception:
+            # Left unsent, so the next evaluation retries it.
+            logger.exception("failed to send quota alert to %s", user.email)
+            continue
+        QuotaAlert.objects.filter(pk__in=[alert.pk for alert in alerts]).update(sent_at=timezone.now())
+        sent += 1
+
+    if sent:
+        logger.info("sent %d quota alerts for %s", sent, period.date())
+    return sent
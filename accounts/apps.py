@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
 
 
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self) -> None:
+        from .backends import invalidate_cached_user
+        from .db import configure_sqlite
+        from .models import User
+
+        connection_created.connect(configure_sqlite, dispatch_uid='accounts.configure_sqlite')
+        post_save.connect(invalidate_cached_user, sender=User, dispatch_uid='accounts.user_saved')
+        post_delete.connect(invalidate_cached_user, sender=User, dispatch_uid='accounts.user_deleted')
@@ -0,0 +1,70 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.core.exceptions import PermissionDenied
+from django.http.request import HttpRequest
+from django.http.response import HttpResponse
+from django.shortcuts import redirect, render
+from django.views import View
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .metrics import render_metrics
+from .models import User
+from .services import get_user_quota
+from .usage import get_daily_usage
+from .views import MetricsView
+from .xray_async import get_async_client
+from .xray_service import xray_aget_snapshot_user
+
+# Async variants of the views that wait on Marzban, used when the project is served
+# through ASGI (see `settings.ASGI`). Anything touching the database is pushed to a
+# thread with `sync_to_async`; Marzban calls go through the shared `AsyncXrayClient`.
+
+
+@sync_to_async
+def _get_user(request: HttpRequest) -> User:
+    # `request.user` is lazy and loads the session and user from the database.
+    request.user.is_authenticated
+    return request.user
+
+
+class AsyncLoginRequiredMixin:
+    async def dispatch(self, request: HttpRequest, *args, **kwargs):
+        user = await _get_user(request)
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncHomeView(AsyncLoginRequiredMixin, View):
+    async def get(self, request: HttpRequest) -> HttpResponse:
+        user: User = request.user
+        username = user.username
+        client = get_async_client()
+        xray_user = await xray_aget_snapshot_user(username=username)
+        if not xray_user:
+            xray_user = await client.get_user(username=username)
+        if not xray_user:
+            user_quota = await sync_to_async(get_user_quota)(user)
+            xray_user = await client.create_user(username=username, traffic_limit=user_quota)
+        usage_history = await sync_to_async(get_daily_usage)(user_id=user.pk)
+        return render(
+            request=request,
+            template_name='accounts/home.html',
+            context={'user': user, 'xray_user': xray_user, 'usage_history': usage_history},
+        )
+
+
+class AsyncConfigResetCredentials(AsyncLoginRequiredMixin, View):
+    async def post(self, request: HttpRequest) -> HttpResponse:
+        await get_async_client().reset_user_credentials(username=request.user.username)
+        return redirect("home")
+
+
+class AsyncMetricsView(MetricsView):
+    async def get(self, request: HttpRequest) -> HttpResponse:
+        if not self.has_access(request=request):
+            raise PermissionDenied()
+
+        metrics = await sync_to_async(render_metrics)()
+
+        return HttpResponse(content=metrics, content_type=CONTENT_TYPE_LATEST)
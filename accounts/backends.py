@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import User
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend that serves `request.user` from the cache, so authenticated requests
+    don't query the user table. `invalidate_cached_user` drops the entry.
+    """
+
+    def get_user(self, user_id):
+        key = User.get_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+        return user
+
+
+def invalidate_cached_user(sender, instance, using, **kwargs) -> None:
+    """
+    Drop the cached `request.user` on `post_save` and `post_delete`; unlike overriding
+    `User.delete()`, these also fire for queryset and admin bulk deletes.
+    """
+    key = User.get_cache_key(instance.pk)
+    # After commit, so a concurrent request can't cache the old row again.
+    transaction.on_commit(lambda: cache.delete(key), using=using)
@@ -0,0 +1,136 @@
+import logging
+from itertools import islice
+from typing import Callable, Iterator
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from .leader import holds_lease
+from .models import BulkJob, User
+from .services import (
+    BulkResult,
+    reset_users_credentials,
+    reset_users_data_usage,
+    set_users_active,
+    sync_traffic_limit,
+)
+
+logger = logging.getLogger(__name__)
+
+# Failures beyond this many are counted but their messages are not stored.
+MAX_STORED_ERRORS = 1000
+
+
+def _sync_policy_limit_users(job: BulkJob) -> QuerySet:
+    traffic_policy_id = job.params['traffic_policy_id']
+    return User.objects.filter(traffic_policy_id=traffic_policy_id).select_related('traffic_policy')
+
+
+def _selected_users(job: BulkJob) -> QuerySet:
+    return User.objects.select_related('traffic_policy')
+
+
+def _sync_limit(users: list[User]) -> BulkResult:
+    return sync_traffic_limit(users=users)
+
+
+def _reset_usage(users: list[User]) -> BulkResult:
+    return reset_users_data_usage(users=users)
+
+
+def _activate(users: list[User]) -> BulkResult:
+    return set_users_active(users=users, is_active=True)
+
+
+def _deactivate(users: list[User]) -> BulkResult:
+    return set_users_active(users=users, is_active=False)
+
+
+def _rotate_credentials(users: list[User]) -> BulkResult:
+    return reset_users_credentials(users=users)
+
+
+# kind -> (users of the job, action applied to one chunk of them)
+_HANDLERS: dict[str, tuple[Callable[[BulkJob], QuerySet], Callable[[list[User]], BulkResult]]] = {
+    BulkJob.Kind.SYNC_POLICY_LIMIT: (_sync_policy_limit_users, _sync_limit),
+    BulkJob.Kind.RESET_USAGE: (_selected_users, _reset_usage),
+    BulkJob.Kind.ACTIVATE: (_selected_users, _activate),
+    BulkJob.Kind.DEACTIVATE: (_selected_users, _deactivate),
+    BulkJob.Kind.SYNC_LIMIT: (_selected_users, _sync_limit),
+    BulkJob.Kind.ROTATE_CREDENTIALS: (_selected_users, _rotate_credentials),
+}
+
+
+def _get_remaining_user_ids(job: BulkJob) -> list[int] | None:
+    if 'user_ids' not in job.params:
+        return None
+    return sorted(user_id for user_id in set(job.params['user_ids']) if user_id > job.last_user_id)
+
+
+def _iter_chunks(users: QuerySet, user_ids: list[int] | None, chunk_size: int) -> Iterator[list[User]]:
+    if user_ids is None:
+        users = users.iterator(chunk_size=chunk_size)
+        while chunk := list(islice(users, chunk_size)):
+            yield chunk
+        return
+
+    # Look the selected users up a chunk of ids at a time; one `pk__in` with every id
+    # of a large selection would exceed SQLite's limit on query parameters.
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = list(users.filter(pk__in=user_ids[start : start + chunk_size]))
+        if chunk:
+            yield chunk
+
+
+def _record_chunk(job: BulkJob, chunk: list[User], result: BulkResult) -> None:
+    job.processed += len(chunk)
+    job.failed += len(result.failed)
+    job.last_user_id = chunk[-1].pk
+    for username, error in result.failed.items():
+        if len(job.errors) >= MAX_STORED_ERRORS:
+            break
+        job.errors[username] = error
+    job.save(update_fields=['processed', 'failed', 'last_user_id', 'errors'])
+
+
+def run_bulk_job(job: BulkJob) -> None:
+    get_users, action = _HANDLERS[job.kind]
+    users = get_users(job).filter(pk__gt=job.last_user_id).order_by('pk')
+    user_ids = _get_remaining_user_ids(job)
+
+    if job.status == BulkJob.Status.PENDING:
+        job.status = BulkJob.Status.RUNNING
+        job.started_at = timezone.now()
+        job.total = users.count() if user_ids is None else len(user_ids)
+        job.save(update_fields=['status', 'started_at', 'total'])
+
+    for chunk in _iter_chunks(users, user_ids, settings.BULK_JOB_CHUNK_SIZE):
+        if not holds_lease():
+            # Left running, so the new leader resumes it after the last recorded chunk.
+            logger.warning("lost the scheduler lease, leaving bulk job %s to the next leader", job.pk)
+            return
+        _record_chunk(job, chunk, action(chunk))
+
+    job.status = BulkJob.Status.DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at'])
+
+
+def run_bulk_jobs() -> None:
+    """
+    Run pending jobs in creation order. Jobs left running by a crashed process are
+    picked up again and resume after their last processed user.
+    """
+    jobs = BulkJob.objects.filter(status__in=[BulkJob.Status.PENDING, BulkJob.Status.RUNNING]).order_by('id')
+    for job in jobs:
+        if not holds_lease():
+            return
+        try:
+            run_bulk_job(job)
+        except Exception as e:
+            logger.exception("bulk job %s failed", job.pk)
+            job.status = BulkJob.Status.FAILED
+            job.finished_at = timezone.now()
+            job.errors['__all__'] = str(e)
+            job.save(update_fields=['status', 'finished_at', 'errors'])
@@ -0,0 +1,19 @@
+from django.conf import settings
+
+
+def configure_sqlite(sender, connection, **kwargs) -> None:
+    """
+    Apply the SQLite pragmas from settings to every new connection.
+
+    WAL lets readers run alongside the single writer and, with `synchronous=NORMAL`,
+    only syncs on checkpoints. `busy_timeout` makes writers wait for the lock instead
+    of failing with "database is locked".
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'PRAGMA journal_mode = {settings.SQLITE_JOURNAL_MODE}')
+        cursor.execute(f'PRAGMA synchronous = {settings.SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA busy_timeout = {settings.SQLITE_BUSY_TIMEOUT:d}')
+        cursor.execute(f'PRAGMA mmap_size = {settings.SQLITE_MMAP_SIZE:d}')
+        cursor.execute(f'PRAGMA cache_size = {settings.SQLITE_CACHE_SIZE:d}')
@@ -0,0 +1,185 @@
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .models import EmailOutboxItem
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class EmailOutboxStats:
+    depth: int
+    lag_seconds: float
+
+
+def enqueue_email(
+    subject: str,
+    recipient_list: list[str],
+    message: str = "",
+    html_message: str = "",
+    priority: EmailOutboxItem.Priority = EmailOutboxItem.Priority.NORMAL,
+    expires_at: Optional[datetime] = None,
+) -> None:
+    """
+    Queue an email for `send_email_outbox`; a drop-in for `send_mail` that returns
+    without talking to SMTP. Emails still queued at `expires_at` are dropped.
+    """
+    EmailOutboxItem.objects.create(
+        subject=subject,
+        body=message,
+        html_body=html_message,
+        recipients=recipient_list,
+        priority=priority,
+        expires_at=expires_at,
+    )
+
+
+def get_email_outbox_stats() -> EmailOutboxStats:
+    """Depth and lag of the emails still to be sent."""
+    stats = EmailOutboxItem.objects.filter(attempts__lt=settings.EMAIL_OUTBOX_MAX_ATTEMPTS).aggregate(
+        depth=Count('id'), oldest=Min('created_at')
+    )
+    lag_seconds = 0.0
+    if stats['oldest'] is not None:
+        lag_seconds = (timezone.now() - stats['oldest']).total_seconds()
+    return EmailOutboxStats(depth=stats['depth'], lag_seconds=lag_seconds)
+
+
+def _get_retry_delay(attempts: int) -> timedelta:
+    delay = settings.EMAIL_OUTBOX_RETRY_BASE_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.EMAIL_OUTBOX_RETRY_MAX_DELAY))
+
+
+def _build_message(item: EmailOutboxItem, connection) -> EmailMultiAlternatives:
+    message = EmailMultiAlternatives(
+        subject=item.subject, body=item.body, to=item.recipients, connection=connection
+    )
+    if item.html_body:
+        message.attach_alternative(item.html_body, 'text/html')
+    return message
+
+
+def _close_connection(connection) -> None:
+    # A connection that just failed may also fail to close; that must not lose the run.
+    try:
+        connection.close()
+    except Exception as e:
+        logger.warning("email outbox: closing the mail server connection failed: %r", e)
+
+
+def _reschedule(item: EmailOutboxItem, error: Exception) -> None:
+    item.attempts += 1
+    item.next_attempt_at = timezone.now() + _get_retry_delay(item.attempts)
+    item.last_error = repr(error)
+    item.save(update_fields=['attempts', 'next_attempt_at', 'last_error'])
+    logger.warning("email outbox: sending %s failed (attempt %d): %r", item, item.attempts, error)
+
+
+def _reconnect(connection) -> bool:
+    _close_connection(connection)
+    try:
+        connection.open()
+    except Exception:
+        logger.exception("email outbox: could not reconnect to the mail server")
+        return False
+    return True
+
+
+def _send_one_by_one(items: list[EmailOutboxItem], connection) -> tuple[int, bool]:
+    """
+    Send `items` one message at a time, rescheduling those that fail. Returns how many
+    were sent and whether the connection is still usable.
+    """
+    sent = 0
+    for item in items:
+        try:
+            if not connection.send_messages([_build_message(item, connection)]):
+                raise RuntimeError("the mail backend sent nothing")
+        except Exception as e:
+            _reschedule(item, e)
+            if not _reconnect(connection):
+                return sent, False
+        else:
+            # Deleted right away, so a crash can't send an email twice.
+            EmailOutboxItem.objects.filter(pk=item.pk).delete()
+            sent += 1
+    return sent, True
+
+
+def send_email_outbox(batch_size: Optional[int] = None) -> int:
+    """
+    Send the due emails of the outbox over a single SMTP connection and return how
+    many were sent. No connection is opened when nothing is due.
+
+    High priority emails go first and expired ones are dropped. Each batch of
+    `batch_size` emails is handed to the backend in one `send_messages` call, paced to
+    `EMAIL_OUTBOX_RATE_LIMIT` per second on average. When a batch fails, which of its
+    messages went out is unknown, so it is retried one message at a time on a new
+    connection (possibly sending some twice); failed emails are rescheduled with
+    exponential backoff. When the connection can't be reopened, the remaining emails
+    wait for the next run.
+    """
+    batch_size = batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE
+    interval = 1 / settings.EMAIL_OUTBOX_RATE_LIMIT if settings.EMAIL_OUTBOX_RATE_LIMIT else 0
+    now = timezone.now()
+    expired, _ = EmailOutboxItem.objects.filter(expires_at__lte=now).delete()
+    if expired:
+        logger.warning("email outbox: dropped %d expired emails", expired)
+    # Sent items are deleted and failed ones rescheduled past `now`, so every batch is
+    # simply the head of this queryset.
+    due = (
+        EmailOutboxItem.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=now),
+            next_attempt_at__lte=now,
+            attempts__lt=settings.EMAIL_OUTBOX_MAX_ATTEMPTS,
+        )
+        .order_by('priority', 'id')
+    )
+    if not due.exists():
+        return 0
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception:
+        logger.exception("email outbox: could not connect to the mail server")
+        return 0
+
+    sent = 0
+    try:
+        while items := list(due[:batch_size]):
+            started_at = time.monotonic()
+            try:
+                messages = [_build_message(item, connection) for item in items]
+                batch_sent = connection.send_messages(messages)
+            except Exception as e:
+                logger.warning("email outbox: a batch of %d failed, retrying one by one: %r", len(items), e)
+                if not _reconnect(connection):
+                    return sent
+                batch_sent, connected = _send_one_by_one(items, connection)
+                sent += batch_sent
+                if not connected:
+                    return sent
+            else:
+                if batch_sent != len(items):
+                    # Only messages without recipients are skipped without an error.
+                    logger.warning("email outbox: the backend sent %d of %d emails", batch_sent, len(items))
+                EmailOutboxItem.objects.filter(pk__in=[item.pk for item in items]).delete()
+                sent += batch_sent
+            remaining = len(items) * interval - (time.monotonic() - started_at)
+            if remaining > 0:
+                time.sleep(remaining)
+    finally:
+        _close_connection(connection)
+
+    if sent:
+        logger.info("email outbox: sent %d emails", sent)
+    return sent
@@ -1,22 +1,183 @@
-from zoneinfo import ZoneInfo
+import gzip
+import json
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
 
-import jdatetime
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, QuerySet
 from django.utils import timezone
 
-from accounts.models import TrafficResetLog, User
+from accounts.models import TrafficResetLog, TrafficResetRun, User
 
-from .services import reset_users_data_usage
+from .alerts import evaluate_quota_alerts
+from .bulk_jobs import run_bulk_jobs
+from .email_outbox import send_email_outbox
+from .leader import holds_lease
+from .metrics import sample_metrics, sample_user_metrics
+from .outbox import drain_xray_outbox
+from .scheduling import get_period_start
+from .services import reconcile_traffic_limit, reset_users_data_usage
+from .usage import rollup_usage_history, store_xray_usage
+from .xray_service import (
+    get_xray_user_snapshot,
+    get_xray_user_snapshot_readings,
+    refresh_xray_user_snapshot,
+    update_remarks,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def is_usage_reset_complete(period: datetime) -> bool:
+    return TrafficResetRun.objects.filter(period=period, completed=True).exists()
+
+
+def get_users_to_reset(period: datetime) -> QuerySet:
+    """
+    Users without a reset log for `period`, as a NOT EXISTS probe of the (date, user)
+    unique index per user, so it stays cheap however many periods are logged.
+    """
+    already_reset = TrafficResetLog.objects.filter(user=OuterRef('pk'), date=period)
+    return User.objects.filter(~Exists(already_reset)).order_by('pk')
 
 
 def rest_usage():
-    now = timezone.now().astimezone(ZoneInfo('Asia/Tehran'))
-    persian_date = jdatetime.date.fromgregorian(date=now.date())
-    if persian_date.day != 1:
+    """
+    Reset every user's usage once per Persian month, on its first day.
+
+    Scheduled with `PersianMonthTrigger`, which wakes this job up every retry interval
+    during the first day of the month; once the period is complete it returns early.
+    """
+    now = timezone.now()
+    period = get_period_start(now)
+    if now - period >= timedelta(days=1):
+        return
+
+    if is_usage_reset_complete(period):
         return
 
-    now = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    users = get_users_to_reset(period)
+    if not users.exists():
+        TrafficResetRun.objects.create(period=period, finished_at=timezone.now(), completed=True)
+        return
+
+    run = TrafficResetRun.objects.create(period=period)
+    chunk_size = settings.USAGE_RESET_CHUNK_SIZE
+    last_user_id = 0
+    while chunk := list(users.filter(pk__gt=last_user_id)[:chunk_size]):
+        if not holds_lease():
+            # The run stays incomplete; the new leader resets the users left.
+            logger.warning("lost the scheduler lease, stopping the usage reset for %s", period.date())
+            return
+        result = reset_users_data_usage(users=chunk)
+        succeeded = set(result.succeeded)
+        # Users that failed get no reset log, so the next run retries them.
+        reset_log_list = [
+            TrafficResetLog(user=user, date=period)
+            for user in chunk
+            if not user.username or user.username in succeeded
+        ]
+        with transaction.atomic():
+            TrafficResetLog.objects.bulk_create(reset_log_list, ignore_conflicts=True)
+            run.users_reset += len(reset_log_list)
+            run.users_failed += len(result.failed)
+            run.save(update_fields=['users_reset', 'users_failed'])
+        last_user_id = chunk[-1].pk
+
+    run.finished_at = timezone.now()
+    run.completed = run.users_failed == 0
+    run.save(update_fields=['finished_at', 'completed'])
+    logger.info(
+        "usage reset for %s: %d users reset, %d failed in %.1fs",
+        period.date(),
+        run.users_reset,
+        run.users_failed,
+        run.duration_seconds,
+    )
+
+
+def purge_traffic_reset_logs() -> int:
+    """
+    Delete reset logs older than `TRAFFIC_RESET_LOG_RETENTION_DAYS` in batches, so the
+    write lock is only held briefly. When `TRAFFIC_RESET_LOG_ARCHIVE_DIR` is set, the
+    rows are first appended to a gzipped JSON lines file there.
+    """
+    if not settings.TRAFFIC_RESET_LOG_RETENTION_DAYS:
+        return 0
+
+    cutoff = timezone.now() - timedelta(days=settings.TRAFFIC_RESET_LOG_RETENTION_DAYS)
+    old_logs = TrafficResetLog.objects.filter(date__lt=cutoff).order_by('date', 'user_id')
+    archive = None
+    purged = 0
+    try:
+        while batch := list(
+            old_logs.values_list('id', 'date', 'user_id', 'user__username', 'user__email')[
+                : settings.TRAFFIC_RESET_LOG_PURGE_BATCH_SIZE
+            ]
+        ):
+            if settings.TRAFFIC_RESET_LOG_ARCHIVE_DIR:
+                if archive is None:
+                    archive_dir = Path(settings.TRAFFIC_RESET_LOG_ARCHIVE_DIR)
+                    archive_dir.mkdir(parents=True, exist_ok=True)
+                    name = f"traffic_reset_logs-{timezone.now():%Y%m%d%H%M%S}.jsonl.gz"
+                    archive = gzip.open(archive_dir / name, 'at', encoding='utf-8')
+                for _, date, user_id, username, email in batch:
+                    row = {'date': date.isoformat(), 'user_id': user_id, 'username': username, 'email': email}
+                    archive.write(json.dumps(row) + '\n')
+                archive.flush()
+            TrafficResetLog.objects.filter(id__in=[row[0] for row in batch]).delete()
+            purged += len(batch)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    if purged:
+        logger.info("purged %d traffic reset logs older than %s", purged, cutoff.date())
+    return purged
+
+
+def refresh_user_snapshot():
+    refresh_xray_user_snapshot()
+    sample_user_metrics(get_xray_user_snapshot())
+
+
+def store_usage():
+    store_xray_usage(get_xray_user_snapshot_readings())
+
+
+def rollup_usage():
+    rollup_usage_history()
+
+
+def send_quota_alerts():
+    evaluate_quota_alerts()
+
+
+def refresh_metrics():
+    sample_metrics()
+
+
+def drain_outbox():
+    drain_xray_outbox()
+
+
+def send_emails():
+    send_email_outbox()
+
+
+def run_background_jobs():
+    run_bulk_jobs()
+
 
-    users = list(User.objects.exclude(traffic_reset_logs__date=now))
-    reset_users_data_usage(users=users)
-    reset_log_list = [TrafficResetLog(user=user, date=now) for user in users]
-    TrafficResetLog.objects.bulk_create(reset_log_list, ignore_conflicts=True)
+def sync_on_startup():
+    result = reconcile_traffic_limit()
+    log = logger.warning if result.failed else logger.info
+    log(
+        "startup sync: %d users checked, %d changed, %d failed",
+        result.checked,
+        result.changed,
+        len(result.failed),
+    )
+    update_remarks(settings.XRAY_REMARK)
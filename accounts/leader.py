@@ -0,0 +1,120 @@
+import logging
+import os
+import socket
+import threading
+from contextvars import ContextVar
+from datetime import timedelta
+from functools import wraps
+from typing import Callable, Optional
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import SchedulerLease
+
+logger = logging.getLogger(__name__)
+
+_current_lease: ContextVar[Optional['LeaderLease']] = ContextVar('current_lease', default=None)
+
+
+def get_holder_id() -> str:
+    host = settings.POD_IP or socket.gethostname()
+    return f"{host}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+class LeaderLease:
+    """
+    Leader election backed by a row in the database.
+
+    Every process calls `try_acquire()` periodically (more often than `ttl`); the row is
+    only taken over once the current holder stopped renewing it. `on_elected` runs in the
+    process that just became leader.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: timedelta,
+        holder: Optional[str] = None,
+        on_elected: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or get_holder_id()
+        self.on_elected = on_elected
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_leader(self) -> bool:
+        # Stop acting as leader as soon as the lease may have lapsed, even if renewing failed.
+        return self._expires_at is not None and timezone.now() < self._expires_at
+
+    def _acquire(self) -> bool:
+        now = timezone.now()
+        expires_at = now + self.ttl
+        updated = (
+            SchedulerLease.objects.filter(name=self.name)
+            .filter(Q(holder=self.holder) | Q(expires_at__lte=now))
+            .update(holder=self.holder, expires_at=expires_at)
+        )
+        if not updated:
+            try:
+                SchedulerLease.objects.create(name=self.name, holder=self.holder, expires_at=expires_at)
+            except IntegrityError:
+                self._expires_at = None
+                return False
+        self._expires_at = expires_at
+        return True
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            was_leader = self.is_leader
+            try:
+                is_leader = self._acquire()
+            except Exception:
+                logger.exception("could not renew lease %s", self.name)
+                return self.is_leader
+
+        if is_leader and not was_leader:
+            logger.info("%s became leader of %s", self.holder, self.name)
+            if self.on_elected:
+                self.on_elected()
+        return is_leader
+
+    def release(self) -> None:
+        with self._lock:
+            lease = SchedulerLease.objects.filter(name=self.name, holder=self.holder)
+            lease.update(expires_at=timezone.now())
+            self._expires_at = None
+
+
+def leader_only(lease: LeaderLease, func: Callable[[], None]) -> Callable[[], None]:
+    """
+    Wrap a scheduled job so it only runs in the process holding `lease`.
+    """
+
+    @wraps(func)
+    def wrapper() -> None:
+        if not lease.is_leader:
+            return
+        token = _current_lease.set(lease)
+        try:
+            func()
+        finally:
+            _current_lease.reset(token)
+
+    return wrapper
+
+
+def holds_lease() -> bool:
+    """
+    Whether a job started by `leader_only` still holds its lease; long jobs check it
+    between chunks so a lapsed leader stops before a new one picks the work up. Always
+    true outside of `leader_only`, e.g. in management commands.
+    """
+    lease = _current_lease.get()
+    return lease is None or lease.is_leader
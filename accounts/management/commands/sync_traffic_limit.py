@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts.models import User
+from accounts.services import BulkResult, reconcile_traffic_limit, sync_traffic_limit
+from accounts.xray_service import update_remarks
+
+
+class Command(BaseCommand):
+    help = "Sync users' traffic limit and active status to Marzban, like a worker does on startup."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help="Push the limit of every user instead of only the users that drifted.",
+        )
+        parser.add_argument(
+            '--skip-remarks',
+            action='store_true',
+            help="Don't update the remark of Marzban hosts.",
+        )
+        parser.add_argument(
+            '--progress-every',
+            type=int,
+            default=100,
+            help="Print progress after this many Marzban updates.",
+        )
+
+    def _progress(self, every: int, total: int | None = None):
+        def progress(result: BulkResult) -> None:
+            if result.total % every:
+                return
+            of_total = f"/{total}" if total is not None else ""
+            self.stdout.write(f"{result.total}{of_total} users updated, {len(result.failed)} failed")
+
+        return progress
+
+    def handle(self, *args, **options):
+        every = max(options['progress_every'], 1)
+
+        if options['full']:
+            total = User.objects.exclude(username='').count()
+            self.stdout.write(f"Pushing traffic limit of {total} users...")
+            result = sync_traffic_limit(progress=self._progress(every, total))
+            changed, failed = len(result.succeeded), result.failed
+            self.stdout.write(f"{result.total} users updated.")
+        else:
+            self.stdout.write("Comparing local users with Marzban...")
+            result = reconcile_traffic_limit(progress=self._progress(every))
+            changed, failed = result.changed, result.failed
+            self.stdout.write(f"{result.checked} users checked, {result.changed} changed.")
+
+        for username, error in sorted(failed.items()):
+            self.stderr.write(f"{username}: {error}")
+
+        if not options['skip_remarks']:
+            update_remarks(settings.XRAY_REMARK)
+            self.stdout.write("Host remarks updated.")
+
+        style = self.style.WARNING if failed else self.style.SUCCESS
+        self.stdout.write(style(f"Done: {changed} updated, {len(failed)} failed."))
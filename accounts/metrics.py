@@ -0,0 +1,346 @@
+import heapq
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from prometheus_client import CollectorRegistry, Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+from .models import User
+from .email_outbox import get_email_outbox_stats
+from .outbox import get_outbox_stats
+from .timing import RequestTimings
+from .xray_metrics import xray_call_metrics
+from .xray_service import XrayError, XrayUser, xray_get_system_info
+
+logger = logging.getLogger(__name__)
+
+
+class SystemMetrics:
+    """
+    Node-wide gauges sampled from Marzban `/api/system`.
+
+    A background job calls `sample()` every `METRICS_SAMPLE_INTERVAL` seconds and the
+    rendered exposition is cached, so a scrape normally only returns bytes. When the
+    cache is older than `max_age`, the first scrape refreshes it and concurrent scrapes
+    wait for that single upstream fetch instead of issuing their own. When Marzban can't
+    be reached, the last exposition is served, or nothing before the first sample.
+
+    The gauges are plain metric families rather than `Gauge` objects, so they stay out
+    of the shared files of the multiprocess mode; every worker reads the same values.
+    """
+
+    def __init__(self, namespace: str, max_age: float) -> None:
+        self.namespace = namespace
+        self.max_age = max_age
+        self._exposition: bytes | None = None
+        self._sampled_at: float | None = None
+        self._lock = threading.Lock()
+
+    def _name(self, name: str) -> str:
+        return f"{self.namespace}_{name}" if self.namespace else name
+
+    def _is_fresh(self) -> bool:
+        return self._sampled_at is not None and time.monotonic() - self._sampled_at <= self.max_age
+
+    def sample(self) -> None:
+        with self._lock:
+            self._sample()
+
+    def _sample(self) -> None:
+        xray_system_info = xray_get_system_info()
+        families = [
+            GaugeMetricFamily(
+                self._name('total_memory_bytes'),
+                "Total available memory in system",
+                value=xray_system_info.total_memory_bytes,
+            ),
+            GaugeMetricFamily(
+                self._name('used_memory_bytes'),
+                "Used memory by all process in system",
+                value=xray_system_info.used_memory_bytes,
+            ),
+            GaugeMetricFamily(
+                self._name('total_users_count'), "Total users count", value=xray_system_info.total_users_count
+            ),
+            GaugeMetricFamily(
+                self._name('active_users_count'),
+                "Active users count",
+                value=xray_system_info.active_users_count,
+            ),
+            GaugeMetricFamily(
+                self._name('total_transmitted_traffic_bytes'),
+                "Total transmitted data in bytes",
+                value=xray_system_info.total_transmitted_traffic_bytes,
+            ),
+            GaugeMetricFamily(
+                self._name('total_received_traffic_bytes'),
+                "Total received data in bytes",
+                value=xray_system_info.total_received_traffic_bytes,
+            ),
+        ]
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(_StaticCollector(families))
+        self._exposition = generate_latest(registry=registry)
+        self._sampled_at = time.monotonic()
+
+    def exposition(self) -> bytes:
+        if self._is_fresh():
+            return self._exposition
+        with self._lock:
+            # Another scrape may have refreshed the cache while this one was waiting.
+            if not self._is_fresh():
+                try:
+                    self._sample()
+                except XrayError as e:
+                    logger.warning("could not sample system metrics: %s", e)
+            return self._exposition or b''
+
+
+class _StaticCollector:
+    def __init__(self, families: list[GaugeMetricFamily]) -> None:
+        self._families = families
+
+    def collect(self):
+        return self._families
+
+
+class UserTrafficMetrics:
+    """
+    Per-user traffic series built from the bulk user snapshot.
+
+    The exposition is rendered once per sample and cached, so scrapes don't pay for
+    formatting tens of thousands of series. Cardinality is bounded by `mode`:
+
+    - "all": one series per user,
+    - "top": only the `top_n` users with the highest used traffic,
+    - "policy": aggregated per traffic policy, no per-user series,
+    - "off": nothing is exported.
+    """
+
+    DEFAULT_POLICY = 'default'
+
+    def __init__(self, namespace: str, mode: str, top_n: int) -> None:
+        if mode not in ('all', 'top', 'policy', 'off'):
+            raise ValueError(f"invalid per-user metrics mode: {mode}")
+        self.namespace = namespace
+        self.mode = mode
+        self.top_n = top_n
+        self._exposition = b''
+
+    def _name(self, name: str) -> str:
+        return f"{self.namespace}_{name}" if self.namespace else name
+
+    def _get_policy_names(self) -> dict[str, str]:
+        return {
+            username: policy_name or self.DEFAULT_POLICY
+            for username, policy_name in User.objects.values_list('username', 'traffic_policy__name')
+        }
+
+    def _user_families(self, xray_users: list[XrayUser], policy_names: dict[str, str]) -> list:
+        labels = ['username', 'traffic_policy']
+        used_traffic = GaugeMetricFamily(
+            self._name('user_used_traffic_bytes'),
+            "Traffic used by the user in the current period",
+            labels=labels,
+        )
+        data_limit = GaugeMetricFamily(
+            self._name('user_data_limit_bytes'), "Traffic limit of the user", labels=labels
+        )
+        status = GaugeMetricFamily(
+            self._name('user_status'), "Marzban status of the user", labels=labels + ['status']
+        )
+        for xray_user in xray_users:
+            user_labels = [xray_user.username, policy_names.get(xray_user.username, self.DEFAULT_POLICY)]
+            used_traffic.add_metric(user_labels, xray_user.used_traffic)
+            data_limit.add_metric(user_labels, xray_user.traffic_limit or 0)
+            status.add_metric(user_labels + [xray_user.status], 1)
+        return [used_traffic, data_limit, status]
+
+    def _policy_families(self, xray_users: list[XrayUser], policy_names: dict[str, str]) -> list:
+        used_traffic = defaultdict(int)
+        data_limit = defaultdict(int)
+        users_count = defaultdict(int)
+        for xray_user in xray_users:
+            policy_name = policy_names.get(xray_user.username, self.DEFAULT_POLICY)
+            used_traffic[policy_name] += xray_user.used_traffic
+            data_limit[policy_name] += xray_user.traffic_limit or 0
+            users_count[(policy_name, xray_user.status)] += 1
+
+        used_traffic_family = GaugeMetricFamily(
+            self._name('policy_used_traffic_bytes'),
+            "Traffic used by all users of the policy in the current period",
+            labels=['traffic_policy'],
+        )
+        for policy_name, value in used_traffic.items():
+            used_traffic_family.add_metric([policy_name], value)
+
+        data_limit_family = GaugeMetricFamily(
+            self._name('policy_data_limit_bytes'),
+            "Sum of traffic limits of all users of the policy",
+            labels=['traffic_policy'],
+        )
+        for policy_name, value in data_limit.items():
+            data_limit_family.add_metric([policy_name], value)
+
+        users_count_family = GaugeMetricFamily(
+            self._name('policy_users_count'),
+            "Users of the policy by Marzban status",
+            labels=['traffic_policy', 'status'],
+        )
+        for (policy_name, status), value in users_count.items():
+            users_count_family.add_metric([policy_name, status], value)
+
+        return [used_traffic_family, data_limit_family, users_count_family]
+
+    def sample(self, xray_users: list[XrayUser]) -> None:
+        if self.mode == 'off':
+            return
+
+        policy_names = self._get_policy_names()
+        if self.mode == 'policy':
+            families = self._policy_families(xray_users, policy_names)
+        else:
+            if self.mode == 'top':
+                xray_users = heapq.nlargest(
+                    self.top_n, xray_users, key=lambda xray_user: xray_user.used_traffic
+                )
+            families = self._user_families(xray_users, policy_names)
+
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(_StaticCollector(families))
+        self._exposition = generate_latest(registry=registry)
+
+    def exposition(self) -> bytes:
+        return self._exposition
+
+
+class OutboxCollector:
+    """
+    Queue depth and lag of the Marzban and email outboxes, read from the database on
+    every scrape.
+    """
+
+    def __init__(self, namespace: str) -> None:
+        self.namespace = namespace
+        self.registry = CollectorRegistry(auto_describe=False)
+        self.registry.register(self)
+
+    def _name(self, name: str) -> str:
+        return f"{self.namespace}_{name}" if self.namespace else name
+
+    def collect(self):
+        stats = get_outbox_stats()
+        yield GaugeMetricFamily(
+            self._name('outbox_depth'), "Pending Marzban operations in the outbox", value=stats.depth
+        )
+        yield GaugeMetricFamily(
+            self._name('outbox_lag_seconds'), "Age of the oldest pending outbox item", value=stats.lag_seconds
+        )
+        email_stats = get_email_outbox_stats()
+        yield GaugeMetricFamily(
+            self._name('email_outbox_depth'), "Emails waiting to be sent", value=email_stats.depth
+        )
+        yield GaugeMetricFamily(
+            self._name('email_outbox_lag_seconds'),
+            "Age of the oldest email waiting to be sent",
+            value=email_stats.lag_seconds,
+        )
+
+    def exposition(self) -> bytes:
+        return generate_latest(registry=self.registry)
+
+
+class RequestMetrics:
+    """
+    Per-view breakdown of request time, fed by `RequestTimingMiddleware`.
+
+    The histograms live in each worker; with several workers they are only merged in
+    multiprocess mode, see `render_metrics`.
+    """
+
+    COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+    def __init__(self, namespace: str) -> None:
+        self.registry = CollectorRegistry(auto_describe=True)
+        self.duration = Histogram(
+            name='request_duration_seconds',
+            documentation="Time spent handling requests, by component (total, db, marzban, template)",
+            labelnames=['url_name', 'component'],
+            namespace=namespace,
+            registry=self.registry,
+        )
+        self.db_queries = Histogram(
+            name='request_db_queries',
+            documentation="Database queries per request",
+            labelnames=['url_name'],
+            buckets=self.COUNT_BUCKETS,
+            namespace=namespace,
+            registry=self.registry,
+        )
+        self.marzban_calls = Histogram(
+            name='request_marzban_calls',
+            documentation="Marzban API calls per request",
+            labelnames=['url_name'],
+            buckets=self.COUNT_BUCKETS,
+            namespace=namespace,
+            registry=self.registry,
+        )
+
+    def observe(self, url_name: str, total: float, timings: RequestTimings) -> None:
+        self.duration.labels(url_name, 'total').observe(total)
+        self.duration.labels(url_name, 'db').observe(timings.db_time)
+        self.duration.labels(url_name, 'marzban').observe(timings.marzban_time)
+        self.duration.labels(url_name, 'template').observe(timings.template_time)
+        self.db_queries.labels(url_name).observe(timings.db_count)
+        self.marzban_calls.labels(url_name).observe(timings.marzban_count)
+
+    def exposition(self) -> bytes:
+        return generate_latest(registry=self.registry)
+
+
+system_metrics = SystemMetrics(namespace=settings.METRICS_NAMESPACE or "", max_age=settings.METRICS_MAX_AGE)
+
+user_traffic_metrics = UserTrafficMetrics(
+    namespace=settings.METRICS_NAMESPACE or "",
+    mode=settings.METRICS_USER_MODE,
+    top_n=settings.METRICS_USER_TOP_N,
+)
+
+outbox_metrics = OutboxCollector(namespace=settings.METRICS_NAMESPACE or "")
+
+request_metrics = RequestMetrics(namespace=settings.METRICS_NAMESPACE or "")
+
+
+def sample_metrics() -> None:
+    system_metrics.sample()
+
+
+def sample_user_metrics(xray_users: list[XrayUser]) -> None:
+    user_traffic_metrics.sample(xray_users)
+
+
+def _process_metrics_exposition() -> bytes:
+    """
+    Marzban call and request metrics. With `PROMETHEUS_MULTIPROC_DIR` set, every worker
+    writes them to files there and they are merged over all workers; otherwise a scrape
+    only sees the worker that answered it.
+    """
+    if not settings.PROMETHEUS_MULTIPROC_DIR:
+        return xray_call_metrics.exposition() + request_metrics.exposition()
+    registry = CollectorRegistry(auto_describe=False)
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry=registry)
+
+
+def render_metrics() -> bytes:
+    return b''.join(
+        [
+            system_metrics.exposition(),
+            outbox_metrics.exposition(),
+            _process_metrics_exposition(),
+            user_traffic_metrics.exposition(),
+        ]
+    )
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http.request import HttpRequest
+from django.http.response import HttpResponseBase
+from django.template.backends.django import Template
+
+from .metrics import request_metrics
+from .timing import RequestTimings, _request_timings, get_request_timings
+
+logger = logging.getLogger(__name__)
+
+
+def _time_query(execute, sql, params, many, context):
+    timings = get_request_timings()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_db(time.perf_counter() - started_at)
+
+
+def _install_query_timer(connection, **kwargs) -> None:
+    if _time_query not in connection.execute_wrappers:
+        # Outermost, so `connection.execute_wrapper()` blocks still pop their own wrapper.
+        connection.execute_wrappers.insert(0, _time_query)
+
+
+def _install_template_timer() -> None:
+    render = Template.render
+    if getattr(render, 'timed', False):
+        return
+
+    @wraps(render)
+    def timed_render(self, context=None, request=None):
+        timings = get_request_timings()
+        if timings is None:
+            return render(self, context, request)
+        started_at = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            timings.add_template(time.perf_counter() - started_at)
+
+    timed_render.timed = True
+    Template.render = timed_render
+
+
+def _milliseconds(seconds: float) -> float:
+    return round(seconds * 1000, 1)
+
+
+class RequestTimingMiddleware:
+    """
+    Break every request down into database, Marzban and template time.
+
+    The breakdown is sent back in a `Server-Timing` header, observed in per-URL-name
+    histograms and logged for requests slower than `REQUEST_SLOW_THRESHOLD` seconds.
+    Keep it first in MIDDLEWARE so the total covers the other middleware too.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Mark the instance as a coroutine function, like Django's MiddlewareMixin.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+        connection_created.connect(_install_query_timer, dispatch_uid='accounts.request_timing')
+        for connection in connections.all(initialized_only=True):
+            _install_query_timer(connection)
+        _install_template_timer()
+
+    def __call__(self, request: HttpRequest):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        started_at = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_timings.reset(token)
+        self.report(request, response, time.perf_counter() - started_at, timings)
+        return response
+
+    async def __acall__(self, request: HttpRequest):
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        started_at = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_timings.reset(token)
+        self.report(request, response, time.perf_counter() - started_at, timings)
+        return response
+
+    def report(self, request: HttpRequest, response: HttpResponseBase, total: float, timings: RequestTimings):
+        resolver_match = request.resolver_match
+        url_name = resolver_match.view_name if resolver_match else 'unmatched'
+        request_metrics.observe(url_name, total, timings)
+
+        if settings.REQUEST_TIMING_HEADER:
+            server_timing = ', '.join(
+                [
+                    f'db;dur={_milliseconds(timings.db_time)};desc="{timings.db_count} queries"',
+                    f'marzban;dur={_milliseconds(timings.marzban_time)};desc="{timings.marzban_count} calls"',
+                    f'template;dur={_milliseconds(timings.template_time)}',
+                    f'total;dur={_milliseconds(total)}',
+                ]
+            )
+            if response.has_header('Server-Timing'):
+                server_timing = f"{response['Server-Timing']}, {server_timing}"
+            response['Server-Timing'] = server_timing
+
+        if settings.REQUEST_SLOW_THRESHOLD and total >= settings.REQUEST_SLOW_THRESHOLD:
+            logger.warning(
+                "slow request %s %s (%s) -> %s: total %.1fms, db %.1fms in %d queries, "
+                "marzban %.1fms in %d calls, template %.1fms",
+                request.method,
+                request.path,
+                url_name,
+                response.status_code,
+                total * 1000,
+                timings.db_time * 1000,
+                timings.db_count,
+                timings.marzban_time * 1000,
+                timings.marzban_count,
+                timings.template_time * 1000,
+            )
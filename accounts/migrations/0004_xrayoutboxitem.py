@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-17 04:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_alter_user_username'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XrayOutboxItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('sync_status', 'Sync active status'), ('sync_limit', 'Sync traffic limit')], max_length=32, verbose_name='operation')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                ('next_attempt_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='next attempt at')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='xray_outbox_items', related_query_name='xray_outbox_items', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.1.7 on 2026-10-17 04:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_xrayoutboxitem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('sync_policy_limit', 'Sync traffic policy limit')], max_length=32, verbose_name='kind')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16, verbose_name='status')),
+                ('params', models.JSONField(blank=True, default=dict, verbose_name='parameters')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='total users')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='processed users')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='failed users')),
+                ('errors', models.JSONField(blank=True, default=dict, verbose_name='errors')),
+                ('last_user_id', models.BigIntegerField(default=0, verbose_name='last processed user id')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='started at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finished at')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='bulk_jobs', related_query_name='bulk_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='bulkjob',
+            index=models.Index(fields=['status', 'id'], name='bulk_job_status_idx'),
+        ),
+    ]
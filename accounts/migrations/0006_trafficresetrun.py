@@ -0,0 +1,29 @@
+# Generated by Django 4.1.7 on 2026-10-17 04:31
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_bulkjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrafficResetRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateTimeField(db_index=True, verbose_name='period')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='started at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finished at')),
+                ('users_reset', models.PositiveIntegerField(default=0, verbose_name='users reset')),
+                ('users_failed', models.PositiveIntegerField(default=0, verbose_name='users failed')),
+                ('completed', models.BooleanField(default=False, verbose_name='completed')),
+            ],
+            options={
+                'ordering': ['-id'],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.1.7 on 2026-10-17 04:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_trafficresetrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerLease',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='name')),
+                ('holder', models.CharField(max_length=255, verbose_name='holder')),
+                ('expires_at', models.DateTimeField(verbose_name='expires at')),
+            ],
+        ),
+    ]
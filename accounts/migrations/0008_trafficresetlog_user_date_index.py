@@ -0,0 +1,24 @@
+# Generated by Django 4.1.7 on 2026-10-17 04:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_schedulerlease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trafficresetlog',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='traffic_rest_logs', related_query_name='traffic_reset_logs', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='trafficresetlog',
+            index=models.Index(fields=['user', 'date'], name='reset_log_user_date_idx'),
+        ),
+    ]
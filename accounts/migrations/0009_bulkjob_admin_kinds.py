@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-17 04:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_trafficresetlog_user_date_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bulkjob',
+            name='kind',
+            field=models.CharField(choices=[('sync_policy_limit', 'Sync traffic policy limit'), ('reset_usage', 'Reset traffic usage'), ('activate', 'Activate users'), ('deactivate', 'Deactivate users'), ('sync_limit', 'Sync traffic limit'), ('rotate_credentials', 'Rotate credentials')], max_length=32, verbose_name='kind'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.1.7 on 2026-10-17 04:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_bulkjob_admin_kinds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XrayUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='xray_usage', related_query_name='xray_usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('used_traffic', models.PositiveBigIntegerField(default=0, verbose_name='used traffic')),
+                ('traffic_limit', models.PositiveBigIntegerField(blank=True, null=True, verbose_name='traffic limit')),
+                ('usage_percent', models.FloatField(blank=True, db_index=True, null=True, verbose_name='usage percent')),
+                ('status', models.CharField(blank=True, max_length=32, verbose_name='status')),
+                ('updated_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='updated at')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.7 on 2026-10-17 04:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_xrayusage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageSample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveIntegerField(choices=[(0, 'Raw'), (3600, 'Hourly'), (86400, 'Daily')], verbose_name='resolution')),
+                ('start', models.DateTimeField(verbose_name='start')),
+                ('traffic', models.PositiveBigIntegerField(verbose_name='traffic')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='usage_samples', related_query_name='usage_samples', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='usagesample',
+            index=models.Index(fields=['resolution', 'start'], name='usage_sample_start_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='usagesample',
+            constraint=models.UniqueConstraint(fields=('user', 'resolution', 'start'), name='usage_sample_user_start_uniq'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.1.7 on 2026-10-17 05:01
+
+import accounts.models
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_usagesample'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trafficpolicy',
+            name='alert_thresholds',
+            field=models.CharField(blank=True, default='80,95,100', help_text='Percentages of the quota at which users are emailed, e.g. 80,95,100. Empty for none.', max_length=64, validators=[accounts.models.validate_alert_thresholds], verbose_name='Alert thresholds'),
+        ),
+        migrations.CreateModel(
+            name='QuotaAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateTimeField(verbose_name='period')),
+                ('threshold', models.PositiveSmallIntegerField(verbose_name='threshold')),
+                ('usage_percent', models.FloatField(verbose_name='usage percent')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='sent at')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='quota_alerts', related_query_name='quota_alerts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='quotaalert',
+            index=models.Index(fields=['period', 'sent_at'], name='quota_alert_period_sent_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='quotaalert',
+            constraint=models.UniqueConstraint(fields=('user', 'period', 'threshold'), name='quota_alert_user_period_uniq'),
+        ),
+    ]
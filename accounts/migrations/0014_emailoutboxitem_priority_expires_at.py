@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-17 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_emailoutboxitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailoutboxitem',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='expires at'),
+        ),
+        migrations.AddField(
+            model_name='emailoutboxitem',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'High'), (1, 'Normal')], default=1, verbose_name='priority'),
+        ),
+    ]
@@ -2,8 +2,10 @@ from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.models import UserManager as _UserManager
 from django.core import validators
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from django.db.models.constraints import UniqueConstraint
+from django.utils import timezone
 from django.utils.deconstruct import deconstructible
 from django.utils.translation import gettext_lazy as _
 
@@ -73,20 +75,90 @@ class User(AbstractUser):
     REQUIRED_FIELDS = []
     objects = UserManager()
 
+    XRAY_FIELDS = {'username', 'is_active', 'traffic_policy'}
+
+    @staticmethod
+    def get_cache_key(user_id) -> str:
+        return f'accounts:user:{user_id}'
+
     def save(self, *args, **kwargs) -> None:
-        super().save(*args, **kwargs)
-        from .services import sync_traffic_limit
-        from .xray_service import xray_activate_user, xray_deactivate_user
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+
+            if not self.username:
+                return
+
+            # e.g. `last_login` updates on every login don't touch Marzban state.
+            if update_fields is not None and not self.XRAY_FIELDS.intersection(update_fields):
+                return
+
+            XrayOutboxItem.objects.bulk_create(
+                [
+                    XrayOutboxItem(user=self, operation=XrayOutboxItem.Operation.SYNC_STATUS),
+                    XrayOutboxItem(user=self, operation=XrayOutboxItem.Operation.SYNC_LIMIT),
+                ]
+            )
+
+
+class XrayUsage(models.Model):
+    """
+    Local copy of a user's Marzban usage, refreshed from the bulk user snapshot by
+    `accounts.usage.store_xray_usage` so the admin can sort and filter on it.
+    """
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="xray_usage",
+        related_query_name="xray_usage",
+    )
+    used_traffic = models.PositiveBigIntegerField(_("used traffic"), default=0)
+    # None when Marzban has no limit for the user.
+    traffic_limit = models.PositiveBigIntegerField(_("traffic limit"), null=True, blank=True)
+    usage_percent = models.FloatField(_("usage percent"), null=True, blank=True, db_index=True)
+    status = models.CharField(_("status"), max_length=32, blank=True)
+    updated_at = models.DateTimeField(_("updated at"), default=timezone.now, db_index=True)
+
+    def __str__(self) -> str:
+        return f"{self.user_id}: {prettify_bytes(self.used_traffic)}"
+
+
+class UsageSample(models.Model):
+    """
+    Traffic a user used in the bucket starting at `start`.
 
-        if not self.username:
-            return
+    `accounts.usage.store_xray_usage` appends raw rows holding the growth of the
+    Marzban usage counter between two snapshots; `rollup_usage_history` moves them into
+    hourly rows and sums complete days of those into daily rows, so the number of rows
+    per user stays bounded by the retention settings.
+    """
 
-        if self.is_active:
-            xray_activate_user(username=self.username)
-        else:
-            xray_deactivate_user(username=self.username)
+    class Resolution(models.IntegerChoices):
+        RAW = 0, _('Raw')
+        HOUR = 3600, _('Hourly')
+        DAY = 86400, _('Daily')
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="usage_samples",
+        related_query_name="usage_samples",
+        # Covered by the (user, resolution, start) constraint below.
+        db_index=False,
+    )
+    resolution = models.PositiveIntegerField(_("resolution"), choices=Resolution.choices)
+    start = models.DateTimeField(_("start"))
+    traffic = models.PositiveBigIntegerField(_("traffic"))
 
-        sync_traffic_limit(users=[self])
+    class Meta:
+        # (user, resolution, start) serves one user's history and the rollup upserts;
+        # (resolution, start) serves the rollups and the retention purge.
+        constraints = [
+            UniqueConstraint(fields=["user", "resolution", "start"], name="usage_sample_user_start_uniq")
+        ]
+        indexes = [models.Index(fields=["resolution", "start"], name="usage_sample_start_idx")]
 
 
 class TrafficResetLog(models.Model):
@@ -96,22 +168,251 @@ class TrafficResetLog(models.Model):
         on_delete=models.CASCADE,
         related_name="traffic_rest_logs",
         related_query_name="traffic_reset_logs",
+        # Covered by the (user, date) index below.
+        db_index=False,
     )
 
     class Meta:
+        # (date, user) serves the reset job's "not reset in this period" probe and the
+        # retention purge; (user, date) serves one user's history and cascades.
         constraints = [UniqueConstraint(fields=["date", "user"], name="rest_log_user_date_uniq")]
+        indexes = [models.Index(fields=["user", "date"], name="reset_log_user_date_idx")]
+
+
+class TrafficResetRun(models.Model):
+    """
+    One execution of the monthly usage reset job for a period.
+
+    A period may take several runs (e.g. after a crash or Marzban failures); it is
+    complete once a run finishes with no user left to reset.
+    """
+
+    period = models.DateTimeField(_("period"), db_index=True)
+    started_at = models.DateTimeField(_("started at"), default=timezone.now)
+    finished_at = models.DateTimeField(_("finished at"), null=True, blank=True)
+    users_reset = models.PositiveIntegerField(_("users reset"), default=0)
+    users_failed = models.PositiveIntegerField(_("users failed"), default=0)
+    completed = models.BooleanField(_("completed"), default=False)
+
+    class Meta:
+        ordering = ['-id']
+
+    @property
+    def duration_seconds(self) -> float | None:
+        if self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    @property
+    def throughput(self) -> float | None:
+        """Users reset per second."""
+        if not self.duration_seconds:
+            return None
+        return self.users_reset / self.duration_seconds
+
+
+def parse_alert_thresholds(value: str) -> list[int]:
+    """
+    Parse comma separated percentages, e.g. "80,95,100", into a sorted list.
+    """
+    try:
+        thresholds = sorted({int(item) for item in value.split(',') if item.strip()})
+    except ValueError:
+        raise ValidationError(_("Enter percentages separated by commas, e.g. 80,95,100."))
+    if any(threshold <= 0 for threshold in thresholds):
+        raise ValidationError(_("Percentages must be greater than zero."))
+    return thresholds
+
+
+def validate_alert_thresholds(value: str) -> None:
+    parse_alert_thresholds(value)
 
 
 class TrafficPolicy(models.Model):
     name = models.CharField(_("Policy Name"), max_length=128)
     quota = models.PositiveBigIntegerField(_('Quota (bytes)'))
+    alert_thresholds = models.CharField(
+        _("Alert thresholds"),
+        max_length=64,
+        blank=True,
+        default="80,95,100",
+        validators=[validate_alert_thresholds],
+        help_text=_("Percentages of the quota at which users are emailed, e.g. 80,95,100. Empty for none."),
+    )
 
     def save(self, *args, **kwargs) -> None:
-        super().save(*args, **kwargs)
-
-        from .services import sync_traffic_limit
+        old_quota = None
+        if self.pk is not None:
+            old_quota = TrafficPolicy.objects.filter(pk=self.pk).values_list('quota', flat=True).first()
 
-        sync_traffic_limit(users=list(self.users.select_related('traffic_policy').all()))
+        self.sync_job = None
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            if old_quota != self.quota:
+                # Pushing the new quota to every user of the policy can take long, so it
+                # runs as a background job; see `accounts.bulk_jobs`.
+                self.sync_job = BulkJob.objects.create(
+                    kind=BulkJob.Kind.SYNC_POLICY_LIMIT,
+                    params={'traffic_policy_id': self.pk},
+                )
 
     def __str__(self) -> str:
         return f"{self.name} ({prettify_bytes(self.quota)})"
+
+
+class QuotaAlert(models.Model):
+    """
+    A quota threshold a user crossed in a usage period, recorded by
+    `accounts.alerts.evaluate_quota_alerts` so every threshold fires once per period.
+    """
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="quota_alerts",
+        related_query_name="quota_alerts",
+        # Covered by the (user, period, threshold) constraint below.
+        db_index=False,
+    )
+    period = models.DateTimeField(_("period"))
+    threshold = models.PositiveSmallIntegerField(_("threshold"))
+    usage_percent = models.FloatField(_("usage percent"))
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    # Unsent alerts are retried on the next evaluation.
+    sent_at = models.DateTimeField(_("sent at"), null=True, blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        constraints = [
+            UniqueConstraint(fields=["user", "period", "threshold"], name="quota_alert_user_period_uniq")
+        ]
+        indexes = [models.Index(fields=["period", "sent_at"], name="quota_alert_period_sent_idx")]
+
+
+class XrayOutboxItem(models.Model):
+    """
+    A pending Marzban side effect of a model change.
+
+    Items are written in the same transaction as the change itself and drained in
+    batches by `accounts.outbox.drain_xray_outbox`. They carry no payload: the
+    worker pushes the user's current state, so several items for the same user and
+    operation collapse into a single call.
+    """
+
+    class Operation(models.TextChoices):
+        SYNC_STATUS = 'sync_status', _('Sync active status')
+        SYNC_LIMIT = 'sync_limit', _('Sync traffic limit')
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="xray_outbox_items",
+        related_query_name="xray_outbox_items",
+    )
+    operation = models.CharField(_("operation"), max_length=32, choices=Operation.choices)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    next_attempt_at = models.DateTimeField(_("next attempt at"), default=timezone.now, db_index=True)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    last_error = models.TextField(_("last error"), blank=True)
+
+
+class EmailOutboxItem(models.Model):
+    """
+    An email waiting to be sent by `accounts.email_outbox.send_email_outbox`, so the
+    request that queued it doesn't wait on SMTP. Sent items are deleted; items that
+    failed `EMAIL_OUTBOX_MAX_ATTEMPTS` times are kept with their last error.
+
+    High priority emails are sent before the others; items past `expires_at` (e.g.
+    password reset links whose token expired) are dropped instead of sent.
+    """
+
+    class Priority(models.IntegerChoices):
+        HIGH = 0, _('High')
+        NORMAL = 1, _('Normal')
+
+    subject = models.CharField(_("subject"), max_length=255)
+    body = models.TextField(_("body"), blank=True)
+    html_body = models.TextField(_("HTML body"), blank=True)
+    recipients = models.JSONField(_("recipients"), default=list)
+    priority = models.PositiveSmallIntegerField(
+        _("priority"), choices=Priority.choices, default=Priority.NORMAL
+    )
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    expires_at = models.DateTimeField(_("expires at"), null=True, blank=True)
+    next_attempt_at = models.DateTimeField(_("next attempt at"), default=timezone.now, db_index=True)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    last_error = models.TextField(_("last error"), blank=True)
+
+    def __str__(self) -> str:
+        return f"{self.subject} ({', '.join(self.recipients)})"
+
+
+class BulkJob(models.Model):
+    """
+    A long-running operation over many users, executed in the background by
+    `accounts.bulk_jobs.run_bulk_jobs`.
+
+    Users are processed in primary key order and `last_user_id` is stored after every
+    chunk, so an interrupted job resumes where it stopped.
+    """
+
+    class Kind(models.TextChoices):
+        SYNC_POLICY_LIMIT = 'sync_policy_limit', _('Sync traffic policy limit')
+        # Admin actions on the users in `params['user_ids']`.
+        RESET_USAGE = 'reset_usage', _('Reset traffic usage')
+        ACTIVATE = 'activate', _('Activate users')
+        DEACTIVATE = 'deactivate', _('Deactivate users')
+        SYNC_LIMIT = 'sync_limit', _('Sync traffic limit')
+        ROTATE_CREDENTIALS = 'rotate_credentials', _('Rotate credentials')
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', _('Pending')
+        RUNNING = 'running', _('Running')
+        DONE = 'done', _('Done')
+        FAILED = 'failed', _('Failed')
+
+    kind = models.CharField(_("kind"), max_length=32, choices=Kind.choices)
+    status = models.CharField(_("status"), max_length=16, choices=Status.choices, default=Status.PENDING)
+    params = models.JSONField(_("parameters"), default=dict, blank=True)
+    total = models.PositiveIntegerField(_("total users"), null=True, blank=True)
+    processed = models.PositiveIntegerField(_("processed users"), default=0)
+    failed = models.PositiveIntegerField(_("failed users"), default=0)
+    errors = models.JSONField(_("errors"), default=dict, blank=True)
+    last_user_id = models.BigIntegerField(_("last processed user id"), default=0)
+    created_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        related_name="bulk_jobs",
+        related_query_name="bulk_jobs",
+        null=True,
+        blank=True,
+    )
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    started_at = models.DateTimeField(_("started at"), null=True, blank=True)
+    finished_at = models.DateTimeField(_("finished at"), null=True, blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [models.Index(fields=['status', 'id'], name='bulk_job_status_idx')]
+
+    @property
+    def progress(self) -> float | None:
+        if not self.total:
+            return None
+        return self.processed / self.total * 100
+
+    def __str__(self) -> str:
+        return f"#{self.pk} {self.get_kind_display()} ({self.get_status_display()})"
+
+
+class SchedulerLease(models.Model):
+    """
+    A named lease held by at most one process at a time; see `accounts.leader`.
+    """
+
+    name = models.CharField(_("name"), max_length=64, primary_key=True)
+    holder = models.CharField(_("holder"), max_length=255)
+    expires_at = models.DateTimeField(_("expires at"))
+
+    def __str__(self) -> str:
+        return f"{self.name} ({self.holder})"
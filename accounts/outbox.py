@@ -0,0 +1,111 @@
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from .models import User, XrayOutboxItem
+from .services import BulkResult, apply_user_state, fan_out, get_user_quota
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class OutboxStats:
+    depth: int
+    lag_seconds: float
+
+
+def get_outbox_stats() -> OutboxStats:
+    stats = XrayOutboxItem.objects.aggregate(depth=Count('id'), oldest=Min('created_at'))
+    lag_seconds = 0.0
+    if stats['oldest'] is not None:
+        lag_seconds = (timezone.now() - stats['oldest']).total_seconds()
+    return OutboxStats(depth=stats['depth'], lag_seconds=lag_seconds)
+
+
+def _get_retry_delay(attempts: int) -> timedelta:
+    delay = settings.XRAY_OUTBOX_RETRY_BASE_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.XRAY_OUTBOX_RETRY_MAX_DELAY))
+
+
+def _drain_batch(batch_size: int) -> Optional[BulkResult]:
+    items = list(
+        XrayOutboxItem.objects.filter(next_attempt_at__lte=timezone.now())
+        .order_by('id')
+        .values_list('id', 'user_id', 'operation', 'attempts')[:batch_size]
+    )
+    if not items:
+        return None
+
+    item_ids_by_user = defaultdict(list)
+    operations_by_user = defaultdict(set)
+    attempts_by_user = defaultdict(int)
+    for item_id, user_id, operation, attempts in items:
+        item_ids_by_user[user_id].append(item_id)
+        operations_by_user[user_id].add(operation)
+        attempts_by_user[user_id] = max(attempts_by_user[user_id], attempts)
+
+    users = User.objects.select_related('traffic_policy').in_bulk(list(item_ids_by_user))
+    user_ids_by_username = {}
+    calls = []
+    for user_id, operations in operations_by_user.items():
+        user = users.get(user_id)
+        if user is None or not user.username:
+            continue
+        kwargs = {'username': user.username}
+        if XrayOutboxItem.Operation.SYNC_LIMIT in operations:
+            kwargs['traffic_limit'] = get_user_quota(user)
+        if XrayOutboxItem.Operation.SYNC_STATUS in operations:
+            kwargs['is_active'] = user.is_active
+        user_ids_by_username[user.username] = user_id
+        calls.append((user.username, kwargs))
+
+    result = fan_out(apply_user_state, calls)
+
+    failed_user_ids = {user_ids_by_username[username] for username in result.failed}
+    done_item_ids = [
+        item_id
+        for user_id, item_ids in item_ids_by_user.items()
+        if user_id not in failed_user_ids
+        for item_id in item_ids
+    ]
+    XrayOutboxItem.objects.filter(id__in=done_item_ids).delete()
+
+    now = timezone.now()
+    for username, error in result.failed.items():
+        user_id = user_ids_by_username[username]
+        attempts = attempts_by_user[user_id] + 1
+        XrayOutboxItem.objects.filter(id__in=item_ids_by_user[user_id]).update(
+            attempts=attempts,
+            next_attempt_at=now + _get_retry_delay(attempts),
+            last_error=error,
+        )
+
+    return result
+
+
+def drain_xray_outbox(batch_size: Optional[int] = None) -> BulkResult:
+    """
+    Push pending outbox items to Marzban until no due item is left.
+
+    Items of one user are collapsed into a single call per batch. Failed users are
+    rescheduled with exponential backoff and stay in the outbox.
+    """
+    batch_size = batch_size or settings.XRAY_OUTBOX_BATCH_SIZE
+    result = BulkResult()
+    while True:
+        batch_result = _drain_batch(batch_size=batch_size)
+        if batch_result is None:
+            break
+        result.merge(batch_result)
+        if batch_result.failed and not batch_result.succeeded:
+            # Marzban is most likely down; wait for the next run instead of spinning.
+            break
+    if result.failed:
+        logger.warning("xray outbox: %d users failed and were rescheduled", len(result.failed))
+    return result
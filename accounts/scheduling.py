@@ -0,0 +1,58 @@
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+import jdatetime
+from apscheduler.triggers.base import BaseTrigger
+
+TEHRAN = ZoneInfo('Asia/Tehran')
+
+
+def get_period_start(moment: datetime) -> datetime:
+    """
+    Midnight (Tehran time) of the first day of the Persian month containing `moment`.
+    """
+    persian_date = jdatetime.date.fromgregorian(date=moment.astimezone(TEHRAN).date())
+    first_day = jdatetime.date(persian_date.year, persian_date.month, 1).togregorian()
+    return datetime.combine(first_day, time.min, tzinfo=TEHRAN)
+
+
+def get_next_period_start(moment: datetime) -> datetime:
+    persian_date = jdatetime.date.fromgregorian(date=moment.astimezone(TEHRAN).date())
+    year, month = persian_date.year, persian_date.month + 1
+    if month > 12:
+        year, month = year + 1, 1
+    first_day = jdatetime.date(year, month, 1).togregorian()
+    return datetime.combine(first_day, time.min, tzinfo=TEHRAN)
+
+
+class PersianMonthTrigger(BaseTrigger):
+    """
+    Fire at the start of every Persian month and stay idle in between.
+
+    While the first day of the month lasts, the job is fired again every
+    `retry_interval`, so failed users are retried; the job itself returns early once
+    the period is complete. The trigger only looks at the clock: APScheduler doesn't
+    catch errors raised here, and one would stop the scheduler thread.
+    """
+
+    def __init__(self, retry_interval: timedelta) -> None:
+        self.retry_interval = retry_interval
+
+    def get_next_fire_time(self, previous_fire_time: datetime | None, now: datetime) -> datetime:
+        period_start = get_period_start(now)
+        first_day_end = period_start + timedelta(days=1)
+
+        if now < first_day_end:
+            if previous_fire_time is None or previous_fire_time < period_start:
+                return now
+            next_fire_time = previous_fire_time + self.retry_interval
+            if next_fire_time < first_day_end:
+                return max(next_fire_time, now)
+
+        return get_next_period_start(now)
+
+    def __str__(self) -> str:
+        return 'persian_month'
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} (retry_interval={self.retry_interval})>"
@@ -1,18 +1,38 @@
+import contextvars
 import json
+import logging
 from base64 import urlsafe_b64encode
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import timedelta
 from hashlib import sha256
-from typing import Optional
+from typing import Callable, Iterable, Optional
 from urllib.parse import urljoin
 
+import requests
 from cryptography.fernet import Fernet, InvalidToken
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.cache import cache
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.translation import gettext
 
-from accounts.models import User
+from accounts.models import EmailOutboxItem, User
 
-from .xray_service import xray_reset_user_usage, xray_update_traffic_limit
+from .email_outbox import enqueue_email
+from .utils import prettify_bytes
+from .xray_service import (
+    XrayError,
+    batch_xray_snapshot_evictions,
+    xray_activate_user,
+    xray_deactivate_user,
+    xray_iter_users,
+    xray_reset_user_credentials,
+    xray_reset_user_usage,
+    xray_update_traffic_limit,
+)
+
+logger = logging.getLogger(__name__)
 
 
 def _get_fernet_key():
@@ -41,7 +61,24 @@ def send_password_reset_url_message(user: User, password_reset_url: str) -> None
     email = user.email
     subject = settings.PASSWORD_RESET_SUBJECT
     message = f'<a href="{password_reset_url}">{password_reset_url}</a>'
-    send_mail(subject=subject, message="", html_message=message, from_email=None, recipient_list=[email])
+    # Ahead of bulk mail such as quota alerts, and useless once the token expired.
+    enqueue_email(
+        subject=subject,
+        html_message=message,
+        recipient_list=[email],
+        priority=EmailOutboxItem.Priority.HIGH,
+        expires_at=timezone.now() + timedelta(seconds=settings.PASSWORD_RESET_TOKEN_TTL),
+    )
+
+
+def send_quota_alert_message(user: User, usage_percent: float, used_traffic: int, traffic_limit: int) -> None:
+    subject = settings.QUOTA_ALERT_SUBJECT
+    message = gettext("You have used %(percent)d%% of your traffic quota (%(used)s of %(limit)s).") % {
+        'percent': usage_percent,
+        'used': prettify_bytes(used_traffic),
+        'limit': prettify_bytes(traffic_limit),
+    }
+    enqueue_email(subject=subject, message=message, recipient_list=[user.email])
 
 
 def send_password_reset_token(user: User) -> None:
@@ -54,7 +91,7 @@ def send_password_reset_token(user: User) -> None:
 
 
 def reset_password(token: str, new_password: str) -> User:
-    data = dict_decrypt(token, ttl=300)
+    data = dict_decrypt(token, ttl=settings.PASSWORD_RESET_TOKEN_TTL)
     email = data['email']
     user: User = User.objects.get(email=email)
     user.set_password(new_password)
@@ -62,27 +99,172 @@ def reset_password(token: str, new_password: str) -> User:
     return user
 
 
-def sync_traffic_limit(users: Optional[list[User]] = None) -> None:
+@dataclass(slots=True)
+class BulkResult:
+    succeeded: list[str] = field(default_factory=list)
+    failed: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def total(self) -> int:
+        return len(self.succeeded) + len(self.failed)
+
+    def merge(self, other: 'BulkResult') -> None:
+        self.succeeded.extend(other.succeeded)
+        self.failed.update(other.failed)
+
+
+def fan_out(
+    func: Callable[..., None],
+    calls: Iterable[tuple[str, dict]],
+    parallelism: Optional[int] = None,
+    progress: Optional[Callable[[BulkResult], None]] = None,
+) -> BulkResult:
+    """
+    Run `func(**kwargs)` for every `(username, kwargs)` pair with at most `parallelism`
+    calls in flight. `calls` is consumed lazily on the calling thread, so it may stream
+    from the database; failures are collected per username instead of aborting the run.
+    `progress` is called with the partial result after every finished call.
+    """
+    parallelism = parallelism or settings.XRAY_BULK_PARALLELISM
+    result = BulkResult()
+    calls = iter(calls)
+
+    # One cache write for the snapshot evictions of the whole batch instead of one per user.
+    with batch_xray_snapshot_evictions(), ThreadPoolExecutor(
+        max_workers=parallelism, thread_name_prefix='xray-bulk'
+    ) as executor:
+        in_flight = {}
+        while True:
+            for username, kwargs in calls:
+                # Run in a copy of the caller's context, so the calls count towards its request timings.
+                context = contextvars.copy_context()
+                in_flight[executor.submit(context.run, func, **kwargs)] = username
+                if len(in_flight) >= parallelism:
+                    break
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                username = in_flight.pop(future)
+                try:
+                    future.result()
+                except (XrayError, requests.RequestException) as e:
+                    logger.warning("marzban call %s failed for %s: %s", func.__name__, username, e)
+                    result.failed[username] = str(e)
+                else:
+                    result.succeeded.append(username)
+                if progress:
+                    progress(result)
+
+    return result
+
+
+def get_user_quota(user: User) -> int:
+    if user.traffic_policy:
+        return user.traffic_policy.quota
+    return settings.MONTHLY_TRAFFIC_LIMIT_BYTES
+
+
+def sync_traffic_limit(
+    users: Optional[Iterable[User]] = None,
+    progress: Optional[Callable[[BulkResult], None]] = None,
+) -> BulkResult:
     if users is None:
-        users: list[User] = list(User.objects.select_related('traffic_policy').all())
-    for user in users:
-        if not user.username:
-            continue
+        users = User.objects.select_related('traffic_policy').iterator()
 
-        user_quota = settings.MONTHLY_TRAFFIC_LIMIT_BYTES
+    calls = (
+        (user.username, {'username': user.username, 'traffic_limit': get_user_quota(user)})
+        for user in users
+        if user.username
+    )
+    return fan_out(xray_update_traffic_limit, calls, progress=progress)
 
-        if user.traffic_policy:
-            user_quota = user.traffic_policy.quota
 
-        xray_update_traffic_limit(username=user.username, traffic_limit=user_quota)
+@dataclass(slots=True)
+class ReconcileResult:
+    checked: int = 0
+    changed: int = 0
+    failed: dict[str, str] = field(default_factory=dict)
 
 
-def reset_users_data_usage(users: Optional[list[User]] = None) -> None:
+def apply_user_state(
+    username: str,
+    traffic_limit: Optional[int] = None,
+    is_active: Optional[bool] = None,
+) -> None:
+    if traffic_limit is not None:
+        xray_update_traffic_limit(username=username, traffic_limit=traffic_limit)
+    if is_active is True:
+        xray_activate_user(username=username)
+    elif is_active is False:
+        xray_deactivate_user(username=username)
+
+
+def reconcile_traffic_limit(progress: Optional[Callable[[BulkResult], None]] = None) -> ReconcileResult:
+    """
+    Compare Marzban's users with the local quota and active flag and only write the
+    users that drifted. Users missing from Marzban are skipped; they are created on
+    their first dashboard visit.
+    """
+    xray_users = {xray_user.username: xray_user for xray_user in xray_iter_users()}
+    result = ReconcileResult()
+
+    def calls():
+        for user in User.objects.select_related('traffic_policy').iterator():
+            xray_user = xray_users.get(user.username)
+            if xray_user is None:
+                continue
+            result.checked += 1
+
+            kwargs = {}
+            user_quota = get_user_quota(user)
+            if xray_user.traffic_limit != user_quota:
+                kwargs['traffic_limit'] = user_quota
+
+            # Marzban moves active users to "limited"/"expired" on its own, so only the
+            # disabled flag is ours to reconcile.
+            if user.is_active and xray_user.status == 'disabled':
+                kwargs['is_active'] = True
+            elif not user.is_active and xray_user.status != 'disabled':
+                kwargs['is_active'] = False
+
+            if kwargs:
+                yield user.username, {'username': user.username, **kwargs}
+
+    bulk_result = fan_out(apply_user_state, calls(), progress=progress)
+    result.changed = len(bulk_result.succeeded)
+    result.failed = bulk_result.failed
+    return result
+
+
+def reset_users_data_usage(users: Optional[Iterable[User]] = None) -> BulkResult:
     if users is None:
-        users = list(User.objects.all())
+        users = User.objects.iterator()
+
+    calls = ((user.username, {'username': user.username}) for user in users if user.username)
+    return fan_out(xray_reset_user_usage, calls)
+
+
+def reset_users_credentials(users: Iterable[User]) -> BulkResult:
+    calls = ((user.username, {'username': user.username}) for user in users if user.username)
+    return fan_out(xray_reset_user_credentials, calls)
+
+
+def set_users_active(users: list[User], is_active: bool) -> BulkResult:
+    """
+    Activate or deactivate `users` locally with one UPDATE, then push the status to
+    Marzban directly instead of through the outbox.
+    """
+    user_ids = [user.pk for user in users]
+    User.objects.filter(pk__in=user_ids).update(is_active=is_active)
+    # update() skips User.save(), so drop the cached users here.
+    cache.delete_many([User.get_cache_key(user_id) for user_id in user_ids])
 
-    for user in users:
-        xray_reset_user_usage(username=user.username)
+    func = xray_activate_user if is_active else xray_deactivate_user
+    calls = ((user.username, {'username': user.username}) for user in users if user.username)
+    return fan_out(func, calls)
 
 
 __all__ = [
@@ -90,6 +272,13 @@ __all__ = [
     'dict_encrypt',
     'dict_decrypt',
     'send_password_reset_token',
+    'send_quota_alert_message',
     'reset_password',
     'sync_traffic_limit',
+    'reset_users_data_usage',
+    'reconcile_traffic_limit',
+    'reset_users_credentials',
+    'set_users_active',
+    'BulkResult',
+    'fan_out',
 ]
@@ -0,0 +1,66 @@
+import logging
+import threading
+from typing import Callable
+
+from apscheduler.schedulers.base import BaseScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTasks:
+    """
+    One-off tasks a worker runs in the background after boot, instead of blocking
+    `post_worker_init` on them. A failed task is retried every `retry_interval`
+    seconds until it succeeds.
+
+    The worker serves requests right away; `is_ready()` turns true once every task
+    added so far has succeeded. The readiness probe only reports it, since the tasks
+    depend on Marzban and run on the leader alone.
+    """
+
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self) -> None:
+        self._status: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, scheduler: BaseScheduler, name: str, func: Callable[[], None], retry_interval: int) -> None:
+        with self._lock:
+            self._status[name] = self.PENDING
+        scheduler.add_job(
+            self._run,
+            args=(scheduler, name, func),
+            trigger=IntervalTrigger(seconds=retry_interval),
+            next_run_time=timezone.now(),
+            id=f'startup:{name}',
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True,
+        )
+
+    def _run(self, scheduler: BaseScheduler, name: str, func: Callable[[], None]) -> None:
+        try:
+            func()
+        except Exception:
+            logger.exception("startup task %s failed, retrying later", name)
+            with self._lock:
+                self._status[name] = self.FAILED
+            return
+
+        with self._lock:
+            self._status[name] = self.DONE
+        scheduler.remove_job(f'startup:{name}')
+
+    def status(self) -> dict[str, str]:
+        with self._lock:
+            return dict(self._status)
+
+    def is_ready(self) -> bool:
+        return all(status == self.DONE for status in self.status().values())
+
+
+startup_tasks = StartupTasks()
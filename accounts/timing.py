@@ -0,0 +1,42 @@
+import threading
+from contextvars import ContextVar
+
+
+class RequestTimings:
+    """
+    Where the time of one request went. Durations are in seconds; Marzban time is the
+    sum of all calls, so it can exceed the wall time when calls ran in parallel.
+    """
+
+    __slots__ = ('db_count', 'db_time', 'marzban_count', 'marzban_time', 'template_time', '_lock')
+
+    def __init__(self) -> None:
+        self.db_count = 0
+        self.db_time = 0.0
+        self.marzban_count = 0
+        self.marzban_time = 0.0
+        self.template_time = 0.0
+        # Bulk actions report Marzban calls from several threads at once.
+        self._lock = threading.Lock()
+
+    def add_db(self, duration: float) -> None:
+        with self._lock:
+            self.db_count += 1
+            self.db_time += duration
+
+    def add_marzban(self, duration: float) -> None:
+        with self._lock:
+            self.marzban_count += 1
+            self.marzban_time += duration
+
+    def add_template(self, duration: float) -> None:
+        with self._lock:
+            self.template_time += duration
+
+
+_request_timings: ContextVar[RequestTimings | None] = ContextVar('request_timings', default=None)
+
+
+def get_request_timings() -> RequestTimings | None:
+    """Timings of the request being handled, or None outside of a request."""
+    return _request_timings.get()
@@ -1,15 +1,28 @@
+from django.conf import settings
 from django.urls import path
 
+from .async_views import AsyncConfigResetCredentials, AsyncHomeView, AsyncMetricsView
 from .views import (
     ConfigResetCredentials,
+    HealthView,
     HomeView,
     LoginView,
     LogoutView,
     MetricsView,
     PasswordResetView,
+    ReadinessView,
     VerifyPasswordResetView,
 )
 
+if settings.ASGI:
+    home_view = AsyncHomeView.as_view()
+    config_reset_credentials_view = AsyncConfigResetCredentials.as_view()
+    metrics_view = AsyncMetricsView.as_view()
+else:
+    home_view = HomeView.as_view()
+    config_reset_credentials_view = ConfigResetCredentials.as_view()
+    metrics_view = MetricsView.as_view()
+
 urlpatterns = [
     path('web/reset-password/', PasswordResetView.as_view(), name='password-reset'),
     path(
@@ -19,7 +32,9 @@ urlpatterns = [
     ),
     path('web/login/', LoginView.as_view(), name='login'),
     path('web/logout/', LogoutView.as_view(), name='logout'),
-    path('', HomeView.as_view(), name='home'),
-    path('web/rest-credentials/', ConfigResetCredentials.as_view(), name='config-reset-credentials'),
-    path('web/metrics/', MetricsView.as_view(), name='metrics'),
+    path('', home_view, name='home'),
+    path('web/rest-credentials/', config_reset_credentials_view, name='config-reset-credentials'),
+    path('web/metrics/', metrics_view, name='metrics'),
+    path('web/health/', HealthView.as_view(), name='health'),
+    path('web/ready/', ReadinessView.as_view(), name='ready'),
 ]
@@ -0,0 +1,201 @@
+import logging
+from datetime import date, datetime, timedelta
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum, Value
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .models import UsageSample, User, XrayUsage
+from .scheduling import TEHRAN
+from .xray_service import XrayUser
+
+logger = logging.getLogger(__name__)
+
+
+def get_usage_percent(used_traffic: int, traffic_limit: int | None) -> float | None:
+    if not traffic_limit:
+        return None
+    return used_traffic / traffic_limit * 100
+
+
+def get_traffic_delta(previous: int | None, current: int) -> int:
+    """
+    Traffic used between two readings of the Marzban usage counter, the second fetched
+    after the first. A counter that went down was reset in between, so everything it
+    counts now was used since.
+    """
+    if previous is None:
+        return 0
+    if current < previous:
+        return current
+    return current - previous
+
+
+def store_xray_usage(readings: list[tuple[XrayUser, float]]) -> int:
+    """
+    Upsert the usage of the `(xray_user, fetched_at)` snapshot readings into `XrayUsage`
+    in bulk, append how much each user used since the previous reading as raw
+    `UsageSample` rows and drop the rows of users missing from the snapshot for longer
+    than `XRAY_USER_SNAPSHOT_MAX_STALENESS`.
+
+    Readings fetched before the stored one are skipped: after a leader change, the new
+    leader's snapshot can be older than what the previous one stored, and its lower
+    counters would pass for resets.
+    """
+    if not readings:
+        return 0
+
+    now = timezone.now()
+    user_ids = dict(User.objects.filter(username__isnull=False).values_list('username', 'pk'))
+    previous = {
+        user_id: (used_traffic, updated_at)
+        for user_id, used_traffic, updated_at in XrayUsage.objects.values_list(
+            'user_id', 'used_traffic', 'updated_at'
+        )
+    }
+    usage_list, sample_list = [], []
+    for xray_user, fetched_at in readings:
+        user_id = user_ids.get(xray_user.username)
+        if user_id is None:
+            continue
+        fetched_at = datetime.fromtimestamp(fetched_at, tz=dt_timezone.utc)
+        previous_traffic, previous_fetched_at = previous.get(user_id, (None, None))
+        if previous_fetched_at is not None and fetched_at <= previous_fetched_at:
+            continue
+        usage_list.append(
+            XrayUsage(
+                user_id=user_id,
+                used_traffic=xray_user.used_traffic,
+                traffic_limit=xray_user.traffic_limit,
+                usage_percent=get_usage_percent(xray_user.used_traffic, xray_user.traffic_limit),
+                status=xray_user.status,
+                updated_at=fetched_at,
+            )
+        )
+        traffic = get_traffic_delta(previous_traffic, xray_user.used_traffic)
+        if traffic:
+            sample_list.append(
+                UsageSample(
+                    user_id=user_id, resolution=UsageSample.Resolution.RAW, start=now, traffic=traffic
+                )
+            )
+
+    with transaction.atomic():
+        XrayUsage.objects.bulk_create(
+            usage_list,
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['used_traffic', 'traffic_limit', 'usage_percent', 'status', 'updated_at'],
+        )
+        UsageSample.objects.bulk_create(sample_list)
+    stale_before = now - timedelta(seconds=settings.XRAY_USER_SNAPSHOT_MAX_STALENESS)
+    deleted, _ = XrayUsage.objects.filter(updated_at__lt=stale_before).delete()
+    logger.debug(
+        "stored usage of %d users, %d samples, dropped %d stale rows",
+        len(usage_list),
+        len(sample_list),
+        deleted,
+    )
+    return len(usage_list)
+
+
+def _get_hour_start(moment: datetime) -> datetime:
+    return moment.astimezone(TEHRAN).replace(minute=0, second=0, microsecond=0)
+
+
+def _get_day_start(moment: datetime) -> datetime:
+    return moment.astimezone(TEHRAN).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _get_buckets(
+    source: UsageSample.Resolution, target: UsageSample.Resolution, start: datetime | None, end: datetime
+):
+    """
+    The `source` rows in [start, end) summed per user into `target` buckets.
+    """
+    trunc = TruncHour if target == UsageSample.Resolution.HOUR else TruncDay
+    samples = UsageSample.objects.filter(resolution=source, start__lt=end)
+    if start is not None:
+        samples = samples.filter(start__gte=start)
+    return (
+        samples.annotate(bucket=trunc('start', tzinfo=TEHRAN))
+        .values('user_id', 'bucket')
+        .annotate(target=Value(target), total=Sum('traffic'))
+        .order_by()
+    )
+
+
+def _upsert_buckets(buckets, previous: dict | None = None) -> None:
+    previous = previous or {}
+    UsageSample.objects.bulk_create(
+        [
+            UsageSample(
+                user_id=row['user_id'],
+                resolution=row['target'],
+                start=row['bucket'],
+                traffic=row['total'] + previous.get((row['user_id'], row['bucket']), 0),
+            )
+            for row in buckets
+        ],
+        update_conflicts=True,
+        unique_fields=['user', 'resolution', 'start'],
+        update_fields=['traffic'],
+    )
+
+
+def rollup_usage_history() -> None:
+    """
+    Move raw samples of complete hours into hourly rows, sum the hourly rows of the last
+    two complete days into daily rows and purge rows past their retention.
+
+    Hours and days are Tehran time, like the usage reset periods. Daily rows are
+    recomputed from the hourly ones, so running late or twice doesn't change them.
+    """
+    now = timezone.now()
+    hour = _get_hour_start(now)
+    day = _get_day_start(now)
+
+    with transaction.atomic():
+        hour_buckets = list(_get_buckets(UsageSample.Resolution.RAW, UsageSample.Resolution.HOUR, None, hour))
+        # Raw rows arriving late for an hour that was already rolled up are added to it.
+        rolled_up = {
+            (user_id, start): traffic
+            for user_id, start, traffic in UsageSample.objects.filter(
+                resolution=UsageSample.Resolution.HOUR, start__in={row['bucket'] for row in hour_buckets}
+            ).values_list('user_id', 'start', 'traffic')
+        }
+        _upsert_buckets(hour_buckets, rolled_up)
+        UsageSample.objects.filter(resolution=UsageSample.Resolution.RAW, start__lt=hour).delete()
+
+    day_buckets = _get_buckets(
+        UsageSample.Resolution.HOUR, UsageSample.Resolution.DAY, day - timedelta(days=2), day
+    )
+    _upsert_buckets(day_buckets)
+
+    hourly_before = day - timedelta(days=max(settings.USAGE_HISTORY_HOURLY_RETENTION_DAYS, 2))
+    daily_before = day - timedelta(days=settings.USAGE_HISTORY_DAILY_RETENTION_DAYS)
+    UsageSample.objects.filter(resolution=UsageSample.Resolution.HOUR, start__lt=hourly_before).delete()
+    UsageSample.objects.filter(resolution=UsageSample.Resolution.DAY, start__lt=daily_before).delete()
+
+
+def get_daily_usage(user_id: int, days: int | None = None) -> list[tuple[date, int]]:
+    """
+    The user's traffic per Tehran day over the last `days` days, oldest first. Past days
+    come from the daily rows, today from the hourly and raw rows not rolled up yet.
+    """
+    days = days or settings.USAGE_HISTORY_DAYS_SHOWN
+    today = _get_day_start(timezone.now())
+    since = today - timedelta(days=days - 1)
+    usage = {(since + timedelta(days=i)).date(): 0 for i in range(days)}
+
+    samples = UsageSample.objects.filter(user_id=user_id, start__gte=since).values_list(
+        'resolution', 'start', 'traffic'
+    )
+    for resolution, start, traffic in samples:
+        is_today = start >= today
+        if (resolution == UsageSample.Resolution.DAY) != is_today:
+            usage[start.astimezone(TEHRAN).date()] += traffic
+    return list(usage.items())
@@ -1,20 +1,33 @@
+import logging
+
 from django import forms
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView as _LoginView
 from django.contrib.auth.views import LogoutView as _LogoutView
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import DatabaseError, connection
 from django.http.request import HttpRequest
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils.crypto import constant_time_compare
 from django.views import View
-from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST
 
+from .metrics import render_metrics
 from .models import User
 from .services import InvalidToken, reset_password, send_password_reset_token
-from .xray_service import xray_create_user, xray_get_system_info, xray_get_user, xray_reset_user_credentials
+from .startup import startup_tasks
+from .usage import get_daily_usage
+from .xray_service import (
+    xray_create_user,
+    xray_get_cached_user,
+    xray_reset_user_credentials,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class PasswordResetView(View):
@@ -110,7 +123,7 @@ class HomeView(LoginRequiredMixin, View):
     def get(self, request: HttpRequest) -> HttpResponse:
         user: User = request.user
         username = user.username
-        xray_user = xray_get_user(username=username)
+        xray_user = xray_get_cached_user(username=username)
         if not xray_user:
             user_quota = settings.MONTHLY_TRAFFIC_LIMIT_BYTES
             if getattr(user, 'traffic_policy', None):
@@ -119,7 +132,11 @@ class HomeView(LoginRequiredMixin, View):
         return render(
             request=request,
             template_name='accounts/home.html',
-            context={'user': request.user, 'xray_user': xray_user},
+            context={
+                'user': request.user,
+                'xray_user': xray_user,
+                'usage_history': get_daily_usage(user_id=user.pk),
+            },
         )
 
 
@@ -167,58 +184,42 @@ class MetricsView(View):
         if not self.has_access(request=request):
             raise PermissionDenied()
 
-        xray_system_info = xray_get_system_info()
-        registry = CollectorRegistry(auto_describe=True)
-        namespace = settings.METRICS_NAMESPACE or ""
+        metrics = render_metrics()
 
-        total_memory = Gauge(
-            name='total_memory_bytes',
-            documentation="Total available memory in system",
-            namespace=namespace,
-            registry=registry,
-        )
-        total_memory.set(xray_system_info.total_memory_bytes)
+        return HttpResponse(content=metrics, content_type=CONTENT_TYPE_LATEST)
 
-        used_memory = Gauge(
-            name='used_memory_bytes',
-            documentation="Used memory by all process in system",
-            namespace=namespace,
-            registry=registry,
-        )
-        used_memory.set(xray_system_info.used_memory_bytes)
 
-        total_users_count = Gauge(
-            name='total_users_count',
-            documentation="Total users count",
-            namespace=namespace,
-            registry=registry,
-        )
-        total_users_count.set(xray_system_info.total_users_count)
+class HealthView(View):
+    def get(self, request: HttpRequest) -> HttpResponse:
+        return HttpResponse(content="ok", content_type="text/plain")
 
-        active_users_count = Gauge(
-            name='active_users_count',
-            documentation="Active users count",
-            namespace=namespace,
-            registry=registry,
-        )
-        active_users_count.set(xray_system_info.active_users_count)
 
-        total_transmitted_traffic = Gauge(
-            name='total_transmitted_traffic_bytes',
-            documentation="Total transmitted data in bytes",
-            namespace=namespace,
-            registry=registry,
-        )
-        total_transmitted_traffic.set(xray_system_info.total_transmitted_traffic_bytes)
+class ReadinessView(View):
+    """
+    Ready as soon as this worker can serve requests on its own: the apps are loaded and
+    the database answers. Marzban is deliberately left out, so an unreachable Marzban or
+    a leader change never takes the pod out of rotation; the startup tasks that need it
+    are only reported in the body.
+    """
 
-        total_received_traffic = Gauge(
-            name='total_received_traffic_bytes',
-            documentation="Total received data in bytes",
-            namespace=namespace,
-            registry=registry,
-        )
-        total_received_traffic.set(xray_system_info.total_received_traffic_bytes)
-
-        metrics = generate_latest(registry=registry)
+    def is_database_reachable(self) -> bool:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except DatabaseError:
+            logger.exception("readiness: database is not reachable")
+            return False
+        return True
 
-        return HttpResponse(content=metrics, content_type=CONTENT_TYPE_LATEST)
+    def get(self, request: HttpRequest) -> HttpResponse:
+        checks = {'apps': apps.ready, 'database': self.is_database_reachable()}
+        ready = all(checks.values())
+        return JsonResponse(
+            {
+                'ready': ready,
+                'checks': checks,
+                'startup_tasks_done': startup_tasks.is_ready(),
+                'startup_tasks': startup_tasks.status(),
+            },
+            status=200 if ready else 503,
+        )
@@ -0,0 +1,259 @@
+import asyncio
+import weakref
+from importlib.util import find_spec
+
+import httpx
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import get_random_string
+
+from .xray_metrics import xray_call_metrics
+from .xray_service import (
+    SystemInfo,
+    XrayError,
+    XrayUser,
+    _breaker,
+    _parse_system_info,
+    _parse_user,
+    _snapshot,
+)
+
+_HTTP2_AVAILABLE = find_spec('h2') is not None
+
+
+class AsyncXrayClient:
+    """
+    asyncio counterpart of the functions in `xray_service`.
+
+    One client owns one connection pool, so it should be created once and shared by
+    every coroutine that talks to Marzban (use it as an async context manager or call
+    `aclose()` when done).
+    """
+
+    def __init__(
+        self,
+        base_url: str | None = None,
+        access_token: str | None = None,
+        max_connections: int | None = None,
+        max_keepalive_connections: int | None = None,
+        keepalive_expiry: float | None = None,
+        timeout: float | None = None,
+        http2: bool | None = None,
+    ) -> None:
+        if http2 is None:
+            http2 = settings.XRAY_ASYNC_HTTP2
+        if max_keepalive_connections is None:
+            max_keepalive_connections = settings.XRAY_ASYNC_MAX_KEEPALIVE_CONNECTIONS
+        limits = httpx.Limits(
+            max_connections=max_connections or settings.XRAY_ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry or settings.XRAY_ASYNC_KEEPALIVE_EXPIRY,
+        )
+        self._client = httpx.AsyncClient(
+            base_url=base_url or settings.MARZBAN_BASE_URL,
+            headers={'Authorization': f"Bearer {access_token or settings.MARZBAN_ACCESS_TOKEN}"},
+            verify=settings.XRAY_SERVER_CERTIFICATE_FILE or True,
+            limits=limits,
+            timeout=timeout or settings.XRAY_ASYNC_TIMEOUT,
+            http2=http2 and _HTTP2_AVAILABLE,
+        )
+
+    async def __aenter__(self) -> 'AsyncXrayClient':
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        operation: str,
+        timeout: float | None = None,
+        **kwargs,
+    ) -> httpx.Response:
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        with xray_call_metrics.track(operation) as call:
+            try:
+                _breaker.before_call()
+            except XrayError:
+                call.status_class = 'circuit_open'
+                raise
+
+            try:
+                response = await self._client.request(method, path, **kwargs)
+            except httpx.HTTPError as e:
+                _breaker.record_failure()
+                call.status_class = 'timeout' if isinstance(e, httpx.TimeoutException) else 'error'
+                raise XrayError({'message': str(e) or e.__class__.__name__, 'path': path}) from e
+
+            call.status_code = response.status_code
+            if response.status_code >= 500:
+                _breaker.record_failure()
+            else:
+                _breaker.record_success()
+            return response
+
+    async def create_user(self, username: str, traffic_limit: int, timeout: float | None = None) -> XrayUser:
+        if not username:
+            raise XrayError(details={"message": "invalid username.", 'username': username})
+
+        data = {
+            "username": username,
+            "proxies": {"shadowsocks": {"password": get_random_string(length=32)}},
+            "inbounds": {"shadowsocks": ['SHADOWSOCKS_INBOUND']},
+            "data_limit_reset_strategy": "no_reset",
+            "data_limit": traffic_limit,
+            "status": "active",
+        }
+
+        response = await self._request('POST', '/api/user', 'create_user', json=data, timeout=timeout)
+        if response.status_code not in [409, 200]:
+            raise XrayError({'status': response.status_code, 'body': response.json()})
+
+        if response.status_code == 409:
+            return await self.get_user(username=username, timeout=timeout)
+
+        xray_user = _parse_user(data=response.json())
+        _snapshot.put(xray_user)
+        return xray_user
+
+    async def get_user(self, username: str, timeout: float | None = None) -> XrayUser | None:
+        if not username:
+            return
+        response = await self._request('GET', f'/api/user/{username}', 'get_user', timeout=timeout)
+
+        if response.status_code == 404:
+            return None
+
+        if response.status_code != 200:
+            raise XrayError({'status': response.status_code, 'body': response.json()})
+
+        xray_user = _parse_user(data=response.json())
+        _snapshot.put(xray_user)
+        return xray_user
+
+    async def list_users(
+        self,
+        page_size: int | None = None,
+        timeout: float | None = None,
+    ) -> list[XrayUser]:
+        page_size = page_size or settings.XRAY_USER_LIST_PAGE_SIZE
+        xray_users = []
+        offset = 0
+        while True:
+            params = {'offset': offset, 'limit': page_size}
+            response = await self._request('GET', '/api/users', 'list_users', params=params, timeout=timeout)
+            if response.status_code != 200:
+                raise XrayError({'status': response.status_code, 'body': response.json()})
+
+            users = response.json()['users']
+            xray_users.extend(_parse_user(data=data) for data in users)
+
+            if len(users) < page_size:
+                return xray_users
+            offset += page_size
+
+    async def _modify_user(
+        self,
+        username: str,
+        data: dict,
+        operation: str,
+        timeout: float | None = None,
+    ) -> None:
+        if not username:
+            return
+        response = await self._request('PUT', f'/api/user/{username}', operation, json=data, timeout=timeout)
+        if response.status_code not in [404, 200]:
+            raise XrayError({'status': response.status_code, 'body': response.json()})
+        await _snapshot.aevict(username)
+
+    async def reset_user_credentials(self, username: str, timeout: float | None = None) -> None:
+        data = {"proxies": {'shadowsocks': {"password": get_random_string(length=32)}}}
+        await self._modify_user(
+            username=username, data=data, operation='reset_user_credentials', timeout=timeout
+        )
+
+    async def reset_user_usage(self, username: str, timeout: float | None = None) -> None:
+        if not username:
+            return
+        response = await self._request(
+            'POST', f'/api/user/{username}/reset', 'reset_user_usage', timeout=timeout
+        )
+        if response.status_code == 404:
+            return
+        if response.status_code != 200:
+            raise XrayError({'status': response.status_code, 'body': response.json()})
+        await _snapshot.aevict(username)
+
+    async def update_traffic_limit(
+        self,
+        username: str,
+        traffic_limit: int,
+        timeout: float | None = None,
+    ) -> None:
+        await self._modify_user(
+            username=username,
+            data={"data_limit": traffic_limit},
+            operation='update_traffic_limit',
+            timeout=timeout,
+        )
+
+    async def activate_user(self, username: str, timeout: float | None = None) -> None:
+        await self._modify_user(
+            username=username, data={"status": "active"}, operation='activate_user', timeout=timeout
+        )
+
+    async def deactivate_user(self, username: str, timeout: float | None = None) -> None:
+        await self._modify_user(
+            username=username, data={"status": "disabled"}, operation='deactivate_user', timeout=timeout
+        )
+
+    async def get_system_info(self, timeout: float | None = None) -> SystemInfo:
+        response = await self._request('GET', '/api/system', 'get_system_info', timeout=timeout)
+        if response.status_code != 200:
+            raise XrayError({'status': response.status_code, 'body': response.json()})
+        return _parse_system_info(data=response.json())
+
+    async def get_hosts(self, timeout: float | None = None) -> dict:
+        response = await self._request('GET', '/api/hosts', 'get_hosts', timeout=timeout)
+        if response.status_code != 200:
+            raise XrayError({'status': response.status_code, 'body': response.json()})
+        return response.json()
+
+    async def update_hosts(self, hosts: dict, timeout: float | None = None) -> None:
+        response = await self._request('PUT', '/api/hosts', 'update_hosts', json=hosts, timeout=timeout)
+        if response.status_code != 200:
+            raise XrayError({'status': response.status_code, 'body': response.json()})
+
+    async def update_remarks(self, remark: str, timeout: float | None = None) -> None:
+        hosts = await self.get_hosts(timeout=timeout)
+        for inbound_tag, inbound_hosts in hosts.items():
+            for host in inbound_hosts:
+                host['remark'] = remark
+        await self.update_hosts(hosts=hosts, timeout=timeout)
+
+
+# Keyed weakly so the entry goes away with a loop that is closed and dropped.
+_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> AsyncXrayClient:
+    """
+    Shared client of the running event loop; httpx pools can't be used across loops.
+
+    Only the ASGI server runs one long-lived loop per worker. Under WSGI every async call
+    gets a loop of its own, so a shared client would leak a pool per request; create an
+    `AsyncXrayClient` in an `async with` block there instead.
+    """
+    if not settings.ASGI:
+        raise ImproperlyConfigured("get_async_client() needs ASGI=true")
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncXrayClient()
+    return client
@@ -0,0 +1,103 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from django.conf import settings
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+from .timing import get_request_timings
+
+
+class XrayCall:
+    """
+    Outcome of one Marzban call, filled in by the caller inside `XrayCallMetrics.track`.
+
+    `status_class` overrides the class derived from `status_code`; it is set to
+    "timeout", "error" or "circuit_open" when no response was received.
+    """
+
+    __slots__ = ('operation', 'status_code', 'status_class')
+
+    def __init__(self, operation: str) -> None:
+        self.operation = operation
+        self.status_code: int | None = None
+        self.status_class: str | None = None
+
+    def get_status_class(self) -> str:
+        if self.status_class is not None:
+            return self.status_class
+        if self.status_code is None:
+            return 'error'
+        return f"{self.status_code // 100}xx"
+
+
+class XrayCallMetrics:
+    """
+    Latency, failures and concurrency of the HTTP calls made to Marzban.
+
+    Both the requests session and the async client report every call through
+    `track()`, so the series cover the request path and the background jobs alike.
+    In multiprocess mode the series of all workers are summed, see `render_metrics`.
+    """
+
+    def __init__(self, namespace: str) -> None:
+        self.registry = CollectorRegistry(auto_describe=True)
+        self.duration = Histogram(
+            name='marzban_request_duration_seconds',
+            documentation="Duration of Marzban API calls",
+            labelnames=['operation', 'status_class'],
+            namespace=namespace,
+            registry=self.registry,
+        )
+        self.errors = Counter(
+            name='marzban_errors',
+            documentation="Failed Marzban API calls: no response (error, timeout, circuit_open) or a 5xx",
+            labelnames=['operation', 'status_class'],
+            namespace=namespace,
+            registry=self.registry,
+        )
+        self.timeouts = Counter(
+            name='marzban_timeouts',
+            documentation="Marzban API calls that timed out",
+            labelnames=['operation'],
+            namespace=namespace,
+            registry=self.registry,
+        )
+        self.in_flight = Gauge(
+            name='marzban_requests_in_flight',
+            documentation="Marzban API calls currently waiting for a response",
+            namespace=namespace,
+            multiprocess_mode='livesum',
+            registry=self.registry,
+        )
+
+    @contextmanager
+    def track(self, operation: str) -> Iterator[XrayCall]:
+        call = XrayCall(operation)
+        self.in_flight.inc()
+        started_at = time.perf_counter()
+        try:
+            yield call
+        except Exception:
+            if call.status_class is None:
+                call.status_class = 'error'
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+            self.in_flight.dec()
+            status_class = call.get_status_class()
+            # 4xx are answers callers handle (e.g. 404 for a missing user), not failures.
+            if not status_class.startswith(('2', '3', '4')):
+                self.errors.labels(operation, status_class).inc()
+            if status_class == 'timeout':
+                self.timeouts.labels(operation).inc()
+            self.duration.labels(operation, status_class).observe(duration)
+            timings = get_request_timings()
+            if timings is not None:
+                timings.add_marzban(duration)
+
+    def exposition(self) -> bytes:
+        return generate_latest(registry=self.registry)
+
+
+xray_call_metrics = XrayCallMetrics(namespace=settings.METRICS_NAMESPACE or "")
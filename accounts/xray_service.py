@@ -1,11 +1,22 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
+from typing import Iterator
 from urllib.parse import urljoin
 
 import requests
 import urllib3
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.crypto import get_random_string
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase
+from urllib3.util.retry import Retry
+
+from .xray_metrics import xray_call_metrics
 
 urllib3.disable_warnings()
 
@@ -19,13 +30,6 @@ class TokenAuth(AuthBase):
         return request
 
 
-_session = requests.Session()
-if settings.XRAY_SERVER_CERTIFICATE_FILE:
-    _session.verify = settings.XRAY_SERVER_CERTIFICATE_FILE
-_session.auth = TokenAuth(settings.MARZBAN_ACCESS_TOKEN)
-_base_url = settings.MARZBAN_BASE_URL
-
-
 class XrayError(Exception):
     def __init__(self, details) -> None:
         self.details = details
@@ -34,12 +38,307 @@ class XrayError(Exception):
         return str(self.details)
 
 
+class JitteredRetry(Retry):
+    """
+    Retry with "full jitter": sleep a random time between zero and the exponential
+    backoff, so retries from many threads don't hit Marzban in lockstep.
+    """
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, timeout: tuple[float, float], *args, **kwargs) -> None:
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class CircuitBreaker:
+    """
+    Fail fast while Marzban is down.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls raise
+    `XrayError` without touching the network. Once `reset_timeout` seconds have passed a
+    single trial call is let through; its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self) -> None:
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._trial_in_flight or time.monotonic() - self._opened_at < self.reset_timeout:
+                raise XrayError({'message': "marzban circuit is open."})
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self.failure_threshold and self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+def _is_timeout(error: requests.RequestException) -> bool:
+    if isinstance(error, requests.Timeout):
+        return True
+    # Once retries are exhausted, read timeouts surface as a ConnectionError around
+    # urllib3's MaxRetryError.
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.TimeoutError)
+
+
+class XraySession(requests.Session):
+    def __init__(self, breaker: CircuitBreaker) -> None:
+        super().__init__()
+        self.breaker = breaker
+
+    def request(self, method, url, *args, operation: str = 'other', **kwargs) -> requests.Response:
+        with xray_call_metrics.track(operation) as call:
+            try:
+                self.breaker.before_call()
+            except XrayError:
+                call.status_class = 'circuit_open'
+                raise
+
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.RequestException as e:
+                self.breaker.record_failure()
+                call.status_class = 'timeout' if _is_timeout(e) else 'error'
+                raise XrayError({'message': str(e), 'method': method, 'url': url}) from e
+
+            call.status_code = response.status_code
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return response
+
+
+_breaker = CircuitBreaker(
+    failure_threshold=settings.XRAY_CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=settings.XRAY_CIRCUIT_RESET_TIMEOUT,
+)
+
+_retry = JitteredRetry(
+    total=settings.XRAY_RETRY_TOTAL,
+    connect=settings.XRAY_RETRY_TOTAL,
+    read=settings.XRAY_RETRY_TOTAL,
+    status=settings.XRAY_RETRY_TOTAL,
+    backoff_factor=settings.XRAY_RETRY_BACKOFF_FACTOR,
+    status_forcelist=[502, 503, 504],
+    # POST (create user, reset usage) is not idempotent and is never retried.
+    allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT']),
+    raise_on_status=False,
+)
+
+_adapter = TimeoutHTTPAdapter(
+    timeout=(settings.XRAY_CONNECT_TIMEOUT, settings.XRAY_READ_TIMEOUT),
+    pool_connections=1,
+    pool_maxsize=settings.XRAY_POOL_MAXSIZE,
+    max_retries=_retry,
+)
+
+_session = XraySession(breaker=_breaker)
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+if settings.XRAY_SERVER_CERTIFICATE_FILE:
+    _session.verify = settings.XRAY_SERVER_CERTIFICATE_FILE
+_session.auth = TokenAuth(settings.MARZBAN_ACCESS_TOKEN)
+_base_url = settings.MARZBAN_BASE_URL
+
+
 @dataclass(frozen=True, slots=True)
 class XrayUser:
     username: str
     shadowsocks_config: str
     used_traffic: int
     traffic_limit: int
+    status: str
+
+
+def _parse_user(data: dict) -> XrayUser:
+    link = [item for item in data['links'] if item.startswith('ss')]
+
+    return XrayUser(
+        username=data['username'],
+        shadowsocks_config=link[0] if link else '',
+        used_traffic=data['used_traffic'],
+        traffic_limit=data['data_limit'],
+        status=data['status'],
+    )
+
+
+class XrayUserSnapshot:
+    """
+    In-memory copy of all Marzban users keyed by username.
+
+    The snapshot is refilled from the bulk listing endpoint every `ttl` seconds by a
+    background job; entries older than `max_staleness` seconds are treated as missing.
+
+    Every worker process holds its own copy, so `evict()` also records the time of the
+    write in the shared Django cache; `get()` ignores entries fetched before the last
+    write to the user, whichever process made it. Inside `batch_evictions()` those
+    write times are collected and stored with one `set_many` when the block exits.
+    """
+
+    def __init__(self, ttl: int, max_staleness: int) -> None:
+        self.ttl = ttl
+        self.max_staleness = max_staleness
+        # Wall-clock fetch times, so they compare with the write times other processes share.
+        self._entries: dict[str, tuple[XrayUser, float]] = {}
+        self._touched: dict[str, float] = {}
+        self._refreshed_at: float | None = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._written_at_batch: ContextVar[dict[str, float] | None] = ContextVar(
+            'xray_written_at_batch', default=None
+        )
+
+    @staticmethod
+    def get_written_at_key(username: str) -> str:
+        return f'accounts:xray_user:written_at:{username}'
+
+    @property
+    def age(self) -> float | None:
+        if self._refreshed_at is None:
+            return None
+        return time.monotonic() - self._refreshed_at
+
+    def _get_entry(self, username: str) -> tuple[XrayUser, float] | None:
+        with self._lock:
+            entry = self._entries.get(username)
+        if entry is None or time.time() - entry[1] > self.max_staleness:
+            return None
+        return entry
+
+    @staticmethod
+    def _is_current(entry: tuple[XrayUser, float], written_at: float | None) -> bool:
+        return written_at is None or written_at < entry[1]
+
+    def get(self, username: str) -> XrayUser | None:
+        entry = self._get_entry(username)
+        if entry is None or not self._is_current(entry, cache.get(self.get_written_at_key(username))):
+            return None
+        return entry[0]
+
+    async def aget(self, username: str) -> XrayUser | None:
+        entry = self._get_entry(username)
+        if entry is None or not self._is_current(entry, await cache.aget(self.get_written_at_key(username))):
+            return None
+        return entry[0]
+
+    def readings(self) -> list[tuple[XrayUser, float]]:
+        """Every entry still within the staleness bound, with its wall-clock fetch time."""
+        now = time.time()
+        with self._lock:
+            entries = list(self._entries.values())
+        return [
+            (xray_user, fetched_at)
+            for xray_user, fetched_at in entries
+            if now - fetched_at <= self.max_staleness
+        ]
+
+    def users(self) -> list[XrayUser]:
+        """Return every entry that is still within the staleness bound."""
+        return [xray_user for xray_user, _ in self.readings()]
+
+    def put(self, xray_user: XrayUser) -> None:
+        now = time.time()
+        with self._lock:
+            self._entries[xray_user.username] = (xray_user, now)
+            self._touched[xray_user.username] = now
+
+    def _evict_local(self, username: str) -> float:
+        now = time.time()
+        with self._lock:
+            self._entries.pop(username, None)
+            self._touched[username] = now
+        return now
+
+    def evict(self, username: str) -> None:
+        written_at = self._evict_local(username)
+        batch = self._written_at_batch.get()
+        if batch is not None:
+            batch[self.get_written_at_key(username)] = written_at
+            return
+        # Older entries are ignored for staleness anyway, so the key can expire with them.
+        cache.set(self.get_written_at_key(username), written_at, timeout=self.max_staleness)
+
+    async def aevict(self, username: str) -> None:
+        written_at = self._evict_local(username)
+        await cache.aset(self.get_written_at_key(username), written_at, timeout=self.max_staleness)
+
+    @contextmanager
+    def batch_evictions(self) -> Iterator[None]:
+        """
+        Collect the write times of `evict()` calls made in this context, including the
+        threads started with a copy of it, and store them together on exit.
+        """
+        batch = {}
+        token = self._written_at_batch.set(batch)
+        try:
+            yield
+        finally:
+            self._written_at_batch.reset(token)
+            if batch:
+                cache.set_many(batch, timeout=self.max_staleness)
+
+    def refresh(self) -> None:
+        with self._refresh_lock:
+            started_at = time.time()
+            refresh_started_at = time.monotonic()
+            entries = {xray_user.username: (xray_user, started_at) for xray_user in xray_iter_users()}
+            with self._lock:
+                # Entries written or evicted while the listing was in flight are newer than
+                # what the listing returned, so they win over it.
+                for username, touched_at in self._touched.items():
+                    if touched_at < started_at:
+                        continue
+                    if username in self._entries:
+                        entries[username] = self._entries[username]
+                    else:
+                        entries.pop(username, None)
+                self._touched = {
+                    username: touched_at
+                    for username, touched_at in self._touched.items()
+                    if touched_at >= started_at
+                }
+                self._entries = entries
+                self._refreshed_at = refresh_started_at
+
+
+_snapshot = XrayUserSnapshot(
+    ttl=settings.XRAY_USER_SNAPSHOT_TTL,
+    max_staleness=settings.XRAY_USER_SNAPSHOT_MAX_STALENESS,
+)
 
 
 def xray_create_user(username: str, traffic_limit: int):
@@ -57,22 +356,16 @@ def xray_create_user(username: str, traffic_limit: int):
         "status": "active",
     }
 
-    response = _session.post(url=url, json=data)
+    response = _session.post(url=url, json=data, operation='create_user')
     if response.status_code not in [409, 200]:
         raise XrayError({'status': response.status_code, 'body': response.json()})
 
     if response.status_code == 409:
         return xray_get_user(username=username)
 
-    data = response.json()
-    link = [item for item in data['links'] if item.startswith('ss')]
-
-    return XrayUser(
-        username=username,
-        shadowsocks_config=link[0],
-        used_traffic=data['used_traffic'],
-        traffic_limit=data['data_limit'],
-    )
+    xray_user = _parse_user(data=response.json())
+    _snapshot.put(xray_user)
+    return xray_user
 
 
 def xray_get_user(username: str) -> XrayUser | None:
@@ -80,7 +373,7 @@ def xray_get_user(username: str) -> XrayUser | None:
         return
     path = f'/api/user/{username}'
     url = urljoin(_base_url, path)
-    response = _session.get(url)
+    response = _session.get(url, operation='get_user')
 
     if response.status_code == 404:
         return None
@@ -88,15 +381,74 @@ def xray_get_user(username: str) -> XrayUser | None:
     if response.status_code != 200:
         raise XrayError({'status': response.status_code, 'body': response.json()})
 
-    data = response.json()
-    link = [item for item in data['links'] if item.startswith('ss')]
+    xray_user = _parse_user(data=response.json())
+    _snapshot.put(xray_user)
+    return xray_user
 
-    return XrayUser(
-        username=username,
-        shadowsocks_config=link[0],
-        used_traffic=data['used_traffic'],
-        traffic_limit=data['data_limit'],
-    )
+
+def xray_iter_users(page_size: int | None = None) -> Iterator[XrayUser]:
+    page_size = page_size or settings.XRAY_USER_LIST_PAGE_SIZE
+    path = '/api/users'
+    url = urljoin(_base_url, path)
+    offset = 0
+    while True:
+        response = _session.get(
+            url=url, params={'offset': offset, 'limit': page_size}, operation='list_users'
+        )
+        if response.status_code != 200:
+            raise XrayError({'status': response.status_code, 'body': response.json()})
+
+        users = response.json()['users']
+        for data in users:
+            yield _parse_user(data=data)
+
+        if len(users) < page_size:
+            return
+        offset += page_size
+
+
+def xray_get_snapshot_user(username: str) -> XrayUser | None:
+    """
+    Look the user up in the local snapshot only, without calling Marzban.
+    """
+    if not username:
+        return
+    return _snapshot.get(username)
+
+
+async def xray_aget_snapshot_user(username: str) -> XrayUser | None:
+    """
+    `xray_get_snapshot_user` for the event loop; the shared cache is read off the loop.
+    """
+    if not username:
+        return
+    return await _snapshot.aget(username)
+
+
+def xray_get_cached_user(username: str) -> XrayUser | None:
+    """
+    Serve the user from the local snapshot and only call Marzban on a miss.
+    """
+    xray_user = xray_get_snapshot_user(username=username)
+    if xray_user is not None:
+        return xray_user
+    return xray_get_user(username=username)
+
+
+def refresh_xray_user_snapshot() -> None:
+    _snapshot.refresh()
+
+
+def get_xray_user_snapshot() -> list[XrayUser]:
+    return _snapshot.users()
+
+
+def get_xray_user_snapshot_readings() -> list[tuple[XrayUser, float]]:
+    return _snapshot.readings()
+
+
+def batch_xray_snapshot_evictions():
+    return _snapshot.batch_evictions()
 
 
 def xray_reset_user_credentials(username: str) -> None:
@@ -105,9 +457,10 @@ def xray_reset_user_credentials(username: str) -> None:
     path = f'/api/user/{username}'
     url = urljoin(_base_url, path)
     data = {"proxies": {'shadowsocks': {"password": get_random_string(length=32)}}}
-    response = _session.put(url=url, json=data)
+    response = _session.put(url=url, json=data, operation='reset_user_credentials')
     if response.status_code not in [404, 200]:
         raise XrayError({'status': response.status_code, 'body': response.json()})
+    _snapshot.evict(username)
 
 
 def xray_reset_user_usage(username: str) -> None:
@@ -115,11 +468,12 @@ def xray_reset_user_usage(username: str) -> None:
         return
     path = f'/api/user/{username}/reset'
     url = urljoin(_base_url, path)
-    response = _session.post(url=url)
+    response = _session.post(url=url, operation='reset_user_usage')
     if response.status_code == 404:
         return
     if response.status_code != 200:
         raise XrayError({'status': response.status_code, 'body': response.json()})
+    _snapshot.evict(username)
 
 
 def xray_update_traffic_limit(username: str, traffic_limit: int) -> None:
@@ -128,9 +482,10 @@ def xray_update_traffic_limit(username: str, traffic_limit: int) -> None:
     path = f'/api/user/{username}'
     url = urljoin(_base_url, path)
     data = {"data_limit": traffic_limit}
-    response = _session.put(url=url, json=data)
+    response = _session.put(url=url, json=data, operation='update_traffic_limit')
     if response.status_code not in [404, 200]:
         raise XrayError({'status': response.status_code, 'body': response.json()})
+    _snapshot.evict(username)
 
 
 def xray_activate_user(username: str) -> None:
@@ -139,9 +494,10 @@ def xray_activate_user(username: str) -> None:
     path = f'/api/user/{username}'
     url = urljoin(_base_url, path)
     data = {"status": "active"}
-    response = _session.put(url=url, json=data)
+    response = _session.put(url=url, json=data, operation='activate_user')
     if response.status_code not in [404, 200]:
         raise XrayError({'status': response.status_code, 'body': response.json()})
+    _snapshot.evict(username)
 
 
 def xray_deactivate_user(username: str) -> None:
@@ -150,16 +506,17 @@ def xray_deactivate_user(username: str) -> None:
     path = f'/api/user/{username}'
     url = urljoin(_base_url, path)
     data = {"status": "disabled"}
-    response = _session.put(url=url, json=data)
+    response = _session.put(url=url, json=data, operation='deactivate_user')
     if response.status_code not in [404, 200]:
         raise XrayError({'status': response.status_code, 'body': response.json()})
+    _snapshot.evict(username)
 
 
 def update_remarks(remark: set) -> None:
     path = "/api/hosts"
     url = urljoin(_base_url, path)
 
-    response = _session.get(url=url)
+    response = _session.get(url=url, operation='get_hosts')
 
     result = response.json()
 
@@ -167,7 +524,7 @@ def update_remarks(remark: set) -> None:
         for host in hosts:
             host['remark'] = remark
 
-    _session.put(url=url, json=result)
+    _session.put(url=url, json=result, operation='update_hosts')
 
 
 @dataclass(frozen=True, slots=True)
@@ -180,11 +537,7 @@ class SystemInfo:
     total_transmitted_traffic_bytes: int
 
 
-def xray_get_system_info() -> SystemInfo:
-    path = '/api/system'
-    url = urljoin(_base_url, path)
-    response = _session.get(url=url)
-    data = response.json()
+def _parse_system_info(data: dict) -> SystemInfo:
     return SystemInfo(
         total_memory_bytes=data['mem_total'],
         used_memory_bytes=data['mem_used'],
@@ -193,3 +546,13 @@ def xray_get_system_info() -> SystemInfo:
         total_received_traffic_bytes=data['incoming_bandwidth'],
         total_transmitted_traffic_bytes=data['outgoing_bandwith'],
     )
+
+
+def xray_get_system_info() -> SystemInfo:
+    path = '/api/system'
+    url = urljoin(_base_url, path)
+    response = _session.get(url=url, operation='get_system_info')
+    if response.status_code != 200:
+        # The body of a proxy error page isn't JSON; the metrics scrape must still get an XrayError.
+        raise XrayError({'status': response.status_code, 'body': response.text})
+    return _parse_system_info(data=response.json())
@@ -0,0 +1,205 @@
+"""
+Local stand-in for the parts of the Marzban API this project uses.
+
+Run it on its own with `python -m benchmarks.fake_marzban --port 8765 --users 1000`
+or embed it through `FakeMarzban`, which is what `benchmarks.run` does.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+_USER_PATH = re.compile(r'^/api/user/(?P<username>[^/]+)(?P<reset>/reset)?$')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeMarzban:
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        users: int = 100,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.users: dict[str, dict] = {}
+        self.hosts = {'SHADOWSOCKS_INBOUND': [{'remark': 'Server', 'address': '127.0.0.1'}]}
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+        for i in range(users):
+            self._add_user(f'user_{i}', data_limit=10 * 1024**3, used_traffic=random.randrange(10 * 1024**3))
+
+        self._server = _Server((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeMarzban':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_calls(self) -> None:
+        with self._lock:
+            self.calls.clear()
+
+    def snapshot_calls(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self.calls)
+
+    def _add_user(self, username: str, data_limit: int, used_traffic: int = 0) -> dict:
+        user = {
+            'username': username,
+            'status': 'active',
+            'used_traffic': used_traffic,
+            'data_limit': data_limit,
+            'links': [f'ss://{username}-{random.getrandbits(64):x}@127.0.0.1:1080'],
+        }
+        self.users[username] = user
+        return user
+
+    def _handle(self, method: str, path: str, query: dict, body: dict) -> tuple[str, int, object]:
+        if path == '/api/users' and method == 'GET':
+            offset = int(query.get('offset', ['0'])[0])
+            limit = int(query.get('limit', ['100'])[0])
+            with self._lock:
+                users = list(self.users.values())[offset : offset + limit]
+                total = len(self.users)
+            return 'list_users', 200, {'users': users, 'total': total}
+
+        if path == '/api/user' and method == 'POST':
+            with self._lock:
+                if body['username'] in self.users:
+                    return 'create_user', 409, {'detail': 'User already exists'}
+                user = self._add_user(body['username'], data_limit=body.get('data_limit'))
+            return 'create_user', 200, user
+
+        if path == '/api/system' and method == 'GET':
+            with self._lock:
+                users = list(self.users.values())
+            return 'system', 200, {
+                'mem_total': 8 * 1024**3,
+                'mem_used': 2 * 1024**3,
+                'total_user': len(users),
+                'users_active': sum(user['status'] == 'active' for user in users),
+                'incoming_bandwidth': sum(user['used_traffic'] for user in users),
+                'outgoing_bandwith': sum(user['used_traffic'] for user in users),
+            }
+
+        if path == '/api/hosts':
+            if method == 'PUT':
+                with self._lock:
+                    self.hosts = body
+                return 'update_hosts', 200, self.hosts
+            return 'get_hosts', 200, self.hosts
+
+        match = _USER_PATH.match(path)
+        if match:
+            username = match['username']
+            if match['reset']:
+                operation = 'reset_usage'
+            else:
+                operation = {'GET': 'get_user', 'PUT': 'modify_user'}.get(method)
+            with self._lock:
+                user = self.users.get(username)
+                if user is None:
+                    return operation, 404, {'detail': 'User not found'}
+                if match['reset'] and method == 'POST':
+                    user['used_traffic'] = 0
+                elif method == 'PUT':
+                    for key in ('data_limit', 'status'):
+                        if key in body:
+                            user[key] = body[key]
+                    if 'proxies' in body:
+                        user['links'] = [f"ss://{body['proxies']['shadowsocks']['password']}@127.0.0.1:1080"]
+                return operation, 200, dict(user)
+
+        return 'unknown', 404, {'detail': 'Not Found'}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _dispatch(self) -> None:
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                url = urlparse(self.path)
+
+                if fake.latency or fake.jitter:
+                    time.sleep(fake.latency + random.uniform(0, fake.jitter))
+
+                if fake.error_rate and random.random() < fake.error_rate:
+                    operation, status, payload = 'error', 500, {'detail': 'Injected error'}
+                else:
+                    operation, status, payload = fake._handle(
+                        self.command, url.path, parse_qs(url.query), body
+                    )
+
+                with fake._lock:
+                    fake.calls[operation] += 1
+
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = _dispatch
+
+        return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeMarzban(
+        host=args.host,
+        port=args.port,
+        users=args.users,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+    )
+    print(f"fake marzban listening on {fake.base_url} with {args.users} users")
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
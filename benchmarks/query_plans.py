@@ -0,0 +1,156 @@
+"""
+Query-count and query-plan regression checks for the monthly usage reset.
+
+    python -m benchmarks.query_plans --users 2000 --months 24
+
+Fills a throwaway database with `--months` periods of reset logs, then checks that the
+job's queries are answered from indexes instead of scanning the reset log table, and
+that the number of queries grows with the number of chunks only. Exits with status 1
+when a check fails.
+"""
+import argparse
+import math
+import sys
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from .fake_marzban import FakeMarzban
+from .run import setup_django
+
+
+def explain(queryset) -> list[str]:
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def check_plan(name: str, queryset, must_use: str | None = None) -> bool:
+    """
+    The plan must not scan the reset log table; with `must_use`, it must search it
+    through that index.
+    """
+    from accounts.models import TrafficResetLog
+
+    table = TrafficResetLog._meta.db_table
+    plan = explain(queryset)
+    scans = [step for step in plan if step.startswith('SCAN') and (table in step or ' U0' in step)]
+    ok = not scans and (must_use is None or any(must_use in step for step in plan))
+    print(f"{'ok  ' if ok else 'FAIL'} plan  {name}")
+    for step in plan:
+        print(f"       {step}")
+    return ok
+
+
+def populate(users: int, months: int) -> list:
+    from django.contrib.auth.hashers import make_password
+    from django.utils import timezone
+
+    from accounts.models import TrafficResetLog, User
+    from accounts.scheduling import get_period_start
+
+    password = make_password(None)
+    User.objects.bulk_create(
+        [
+            User(username=f'user_{i}', email=f'user_{i}@bench.local', password=password)
+            for i in range(users)
+        ],
+        batch_size=500,
+    )
+    user_ids = list(User.objects.values_list('pk', flat=True))
+
+    periods = []
+    period = get_period_start(timezone.now())
+    for _ in range(months):
+        period = get_period_start(period - timedelta(days=1))
+        periods.append(period)
+        TrafficResetLog.objects.bulk_create(
+            [TrafficResetLog(user_id=user_id, date=period) for user_id in user_ids], batch_size=1000
+        )
+    return periods
+
+
+def check_reset_queries(users: int) -> bool:
+    """
+    A full reset must cost a bounded number of queries per chunk, not per user.
+    """
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django.utils import timezone
+
+    from accounts.jobs import rest_usage
+    from accounts.scheduling import get_period_start
+
+    first_hour = get_period_start(timezone.now()) + timedelta(hours=1)
+    chunks = math.ceil(users / settings.USAGE_RESET_CHUNK_SIZE)
+    # Per chunk: select users, BEGIN, insert logs, update the run. Around them: the
+    # completion and emptiness checks, creating and finishing the run, the last select.
+    budget = 4 * chunks + 5
+    with CaptureQueriesContext(connection) as queries:
+        with mock.patch('django.utils.timezone.now', return_value=first_hour):
+            rest_usage()
+    ok = len(queries) <= budget
+    print(
+        f"{'ok  ' if ok else 'FAIL'} count rest_usage: {len(queries)} queries for {users} users"
+        f" (budget {budget})"
+    )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--months', type=int, default=24, help="Periods of reset logs to fill in.")
+    args = parser.parse_args()
+
+    fake = FakeMarzban(users=args.users).start()
+    with tempfile.TemporaryDirectory(prefix='net-query-plans-') as database_dir:
+        setup_django(fake, database_dir)
+
+        from django.core.management import call_command
+        from django.db import connection
+        from django.utils import timezone
+
+        from accounts.jobs import get_users_to_reset
+        from accounts.models import TrafficResetLog
+        from accounts.scheduling import get_period_start
+
+        call_command('migrate', verbosity=0)
+        periods = populate(args.users, args.months)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        period = get_period_start(timezone.now())
+        cutoff = periods[len(periods) // 2]
+        results = [
+            check_plan(
+                'users to reset',
+                get_users_to_reset(period).filter(pk__gt=0)[:200],
+                # SQLite names the index of the (date, user) unique constraint itself.
+                must_use='USING COVERING INDEX',
+            ),
+            check_plan(
+                'purge old logs',
+                TrafficResetLog.objects.filter(date__lt=cutoff).order_by('date', 'user_id')[:1000],
+            ),
+            check_plan(
+                "one user's history",
+                TrafficResetLog.objects.filter(user_id=1).order_by('-date'),
+                must_use='reset_log_user_date_idx',
+            ),
+            check_reset_queries(args.users),
+        ]
+        fake.stop()
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,519 @@
+"""
+Benchmark the request paths and background jobs against a local fake Marzban.
+
+    python -m benchmarks.run --users 1000 --latency-ms 20 --concurrency 1,10,50
+    python -m benchmarks.run --baseline benchmarks/results/before.json --max-regression 20
+    SQLITE_JOURNAL_MODE=DELETE DATABASE_CONN_MAX_AGE=0 python -m benchmarks.run --scenarios database
+
+Every scenario reports p50/p99 latency, throughput and the Marzban calls it made.
+Results are written as JSON (`--output`) and can be compared against an earlier run
+(`--baseline`); with `--max-regression` the run fails when a p99 or throughput got
+worse by more than that many percent.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Callable
+from unittest import mock
+
+from .fake_marzban import FakeMarzban
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+BENCHMARK_ENV = {
+    'SECRET_KEY': 'benchmark',
+    'DEBUG': 'False',
+    'ALLOWED_HOSTS': 'testserver',
+    'EMAIL_HOST': 'localhost',
+    'EMAIL_HOST_PASSWORD': '',
+    'EMAIL_HOST_USER': '',
+    'EMAIL_PORT': '25',
+    'DEFAULT_FROM_EMAIL': 'benchmark@localhost',
+    'PASSWORD_RESET_SUBJECT': 'Password reset',
+    'WEB_BASE_URL': 'http://testserver',
+    'MARZBAN_ACCESS_TOKEN': 'benchmark',
+    'MONTHLY_TRAFFIC_LIMIT_BYTES': str(10 * 1024**3),
+    'METRICS_ACCESS_TOKEN': 'benchmark',
+}
+
+
+def summarize(latencies: list[float], wall_time: float, errors: int, calls: dict[str, int]) -> dict:
+    latencies = sorted(latencies)
+    count = len(latencies)
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if count > 1 else latencies * 99
+    return {
+        'requests': count,
+        'errors': errors,
+        'wall_time_s': round(wall_time, 4),
+        'throughput_rps': round(count / wall_time, 2) if wall_time else None,
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies) * 1000, 3) if count else None,
+            'p50': round(percentiles[49] * 1000, 3) if count else None,
+            'p90': round(percentiles[89] * 1000, 3) if count else None,
+            'p99': round(percentiles[98] * 1000, 3) if count else None,
+            'max': round(latencies[-1] * 1000, 3) if count else None,
+        },
+        'marzban_calls': calls,
+        'marzban_calls_per_request': round(sum(calls.values()) / count, 3) if count else None,
+    }
+
+
+class Bench:
+    def __init__(self, fake: FakeMarzban, args: argparse.Namespace) -> None:
+        self.fake = fake
+        self.args = args
+        self._session_keys: dict[int, str] | None = None
+
+    def setup_database(self) -> None:
+        from django.contrib.auth.hashers import make_password
+        from django.core.management import call_command
+
+        from accounts.models import User
+
+        call_command('migrate', verbosity=0)
+        password = make_password(None)
+        User.objects.bulk_create(
+            [
+                User(username=username, email=f'{username}@bench.local', password=password)
+                for username in self.fake.users
+            ],
+            batch_size=500,
+        )
+
+    def get_session_keys(self, users) -> dict[int, str]:
+        """
+        Log every user in once, up front, so logins are neither measured nor racing
+        the scenario for the database.
+        """
+        from django.conf import settings
+        from django.test import Client
+
+        if self._session_keys is None:
+            self._session_keys = {}
+            for user in users:
+                client = Client()
+                client.force_login(user)
+                self._session_keys[user.pk] = client.cookies[settings.SESSION_COOKIE_NAME].value
+        return self._session_keys
+
+    def reset_state(self) -> None:
+        from accounts.xray_service import _breaker, refresh_xray_user_snapshot
+
+        # Warm the snapshot without injected errors, so every scenario starts alike.
+        error_rate, self.fake.error_rate = self.fake.error_rate, 0.0
+        try:
+            _breaker.record_success()
+            refresh_xray_user_snapshot()
+        finally:
+            self.fake.error_rate = error_rate
+        self.fake.reset_calls()
+
+    def run_requests(
+        self,
+        request: Callable[..., int],
+        concurrency: int,
+        before_request: Callable[[int], None] | None = None,
+    ) -> dict:
+        """
+        Send `--requests` requests from `concurrency` threads, each with its own client.
+        `request(client, user)` returns the response status.
+        """
+        from django.conf import settings
+        from django.contrib.auth import get_user_model
+        from django.db import connections
+        from django.test import Client
+
+        usernames = list(self.fake.users)
+        users = get_user_model().objects.in_bulk(usernames, field_name='username')
+        session_keys = self.get_session_keys(users.values())
+        total = self.args.requests
+        counter = iter(range(total))
+        counter_lock = threading.Lock()
+        latencies, errors = [], 0
+        results_lock = threading.Lock()
+
+        def worker() -> None:
+            nonlocal errors
+            client = Client(raise_request_exception=False)
+            try:
+                while True:
+                    with counter_lock:
+                        i = next(counter, None)
+                    if i is None:
+                        return
+                    user = users[usernames[i % len(usernames)]]
+                    client.cookies[settings.SESSION_COOKIE_NAME] = session_keys[user.pk]
+                    if before_request is not None:
+                        before_request(i)
+                    start = time.perf_counter()
+                    status = request(client, user)
+                    elapsed = time.perf_counter() - start
+                    with results_lock:
+                        latencies.append(elapsed)
+                        errors += status >= 400
+            finally:
+                connections.close_all()
+
+        self.reset_state()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.perf_counter() - start
+        return summarize(latencies, wall_time, errors, self.fake.snapshot_calls())
+
+    def run_rounds(
+        self, func: Callable[[], tuple[int, int]], prepare: Callable[[], None] | None = None
+    ) -> dict:
+        """
+        Time `func` `--rounds` times; it returns how many users it processed and how many
+        of them failed, so the throughput is in users per second.
+        """
+        latencies, processed, errors = [], 0, 0
+        self.reset_state()
+        calls = {}
+        for _ in range(self.args.rounds):
+            if prepare is not None:
+                prepare()
+            self.fake.reset_calls()
+            start = time.perf_counter()
+            round_processed, round_errors = func()
+            processed += round_processed
+            errors += round_errors
+            latencies.append(time.perf_counter() - start)
+            for operation, count in self.fake.snapshot_calls().items():
+                calls[operation] = calls.get(operation, 0) + count
+        result = summarize(latencies, sum(latencies), errors, calls)
+        result['users_processed'] = processed
+        result['throughput_users_per_s'] = round(processed / sum(latencies), 2) if latencies else None
+        return result
+
+    def dashboard(self, concurrency: int) -> dict:
+        return self.run_requests(lambda client, user: client.get('/').status_code, concurrency)
+
+    def dashboard_cold(self, concurrency: int) -> dict:
+        from accounts.xray_service import _snapshot
+
+        usernames = list(self.fake.users)
+
+        def evict(i: int) -> None:
+            _snapshot.evict(usernames[i % len(usernames)])
+
+        return self.run_requests(lambda client, user: client.get('/').status_code, concurrency, evict)
+
+    def metrics(self, concurrency: int) -> dict:
+        from accounts.metrics import sample_user_metrics
+        from accounts.xray_service import get_xray_user_snapshot
+
+        sample_user_metrics(get_xray_user_snapshot())
+        headers = {'HTTP_AUTHORIZATION': f"Bearer {os.environ['METRICS_ACCESS_TOKEN']}"}
+        return self.run_requests(
+            lambda client, user: client.get('/web/metrics/', **headers).status_code, concurrency
+        )
+
+    def password_reset(self, concurrency: int) -> dict:
+        from accounts.models import EmailOutboxItem
+
+        EmailOutboxItem.objects.all().delete()
+        return self.run_requests(
+            lambda client, user: client.post('/web/reset-password/', {'email': user.email}).status_code,
+            concurrency,
+        )
+
+    def database(self, concurrency: int) -> dict:
+        """
+        Request-shaped ORM work without HTTP: every operation opens and closes its
+        database connection the way a request does, reads a user and a session and,
+        for `--write-ratio` of them, writes a reset log row in a transaction. Lock
+        errors ("database is locked") are counted as errors.
+        """
+        from django.contrib.sessions.models import Session
+        from django.db import OperationalError, close_old_connections, connections, transaction
+        from django.utils import timezone
+
+        from accounts.models import TrafficResetLog, User
+
+        user_ids = list(User.objects.values_list('pk', flat=True))
+        write_every = max(int(1 / self.args.write_ratio), 1) if self.args.write_ratio else 0
+        counter = iter(range(self.args.requests))
+        counter_lock = threading.Lock()
+        latencies, errors = [], 0
+        results_lock = threading.Lock()
+
+        def operation(i: int) -> None:
+            user_id = user_ids[i % len(user_ids)]
+            User.objects.get(pk=user_id)
+            Session.objects.filter(session_key=f'benchmark-{user_id}').first()
+            if write_every and i % write_every == 0:
+                with transaction.atomic():
+                    TrafficResetLog.objects.create(user_id=user_id, date=timezone.now())
+
+        def worker() -> None:
+            nonlocal errors
+            try:
+                while True:
+                    with counter_lock:
+                        i = next(counter, None)
+                    if i is None:
+                        return
+                    start = time.perf_counter()
+                    close_old_connections()
+                    try:
+                        operation(i)
+                        failed = False
+                    except OperationalError:
+                        failed = True
+                    close_old_connections()
+                    elapsed = time.perf_counter() - start
+                    with results_lock:
+                        latencies.append(elapsed)
+                        errors += failed
+            finally:
+                connections.close_all()
+
+        self.reset_state()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.perf_counter() - start
+        TrafficResetLog.objects.all().delete()
+        return summarize(latencies, wall_time, errors, self.fake.snapshot_calls())
+
+    def bulk_sync(self) -> dict:
+        from accounts.services import reconcile_traffic_limit
+
+        def drift() -> None:
+            # Let a share of Marzban's users drift from the local quota.
+            step = max(int(1 / self.args.drift), 1) if self.args.drift else 0
+            for i, user in enumerate(self.fake.users.values()):
+                if step and i % step == 0:
+                    user['data_limit'] = 1
+
+        def reconcile() -> tuple[int, int]:
+            result = reconcile_traffic_limit()
+            return result.checked, len(result.failed)
+
+        return self.run_rounds(reconcile, prepare=drift)
+
+    def bulk_sync_full(self) -> dict:
+        from accounts.services import sync_traffic_limit
+
+        def sync() -> tuple[int, int]:
+            result = sync_traffic_limit()
+            return result.total, len(result.failed)
+
+        return self.run_rounds(sync)
+
+    def monthly_reset(self) -> dict:
+        from accounts.jobs import rest_usage
+        from accounts.models import TrafficResetLog, TrafficResetRun, User
+        from accounts.scheduling import get_period_start
+        from django.utils import timezone
+
+        # Pretend it is the first hour of the Persian month so the job does its work.
+        first_hour = get_period_start(timezone.now()) + timedelta(hours=1)
+
+        def prepare() -> None:
+            TrafficResetLog.objects.all().delete()
+            TrafficResetRun.objects.all().delete()
+
+        def reset() -> tuple[int, int]:
+            with mock.patch('django.utils.timezone.now', return_value=first_hour):
+                rest_usage()
+            return User.objects.count(), TrafficResetRun.objects.get().users_failed
+
+        return self.run_rounds(reset, prepare=prepare)
+
+    def usage_refresh(self) -> dict:
+        from accounts.usage import store_xray_usage
+        from accounts.xray_service import get_xray_user_snapshot_readings, refresh_xray_user_snapshot
+
+        def store() -> tuple[int, int]:
+            return store_xray_usage(get_xray_user_snapshot_readings()), 0
+
+        # Readings no newer than the stored ones are skipped, so every round needs a fresh snapshot.
+        return self.run_rounds(store, prepare=refresh_xray_user_snapshot)
+
+    def run(self) -> dict:
+        results = {}
+        for name in self.args.scenarios:
+            scenario = getattr(self, name)
+            if name in REQUEST_SCENARIOS:
+                for concurrency in self.args.concurrency:
+                    key = f'{name}@{concurrency}'
+                    results[key] = scenario(concurrency)
+                    print_result(key, results[key])
+            else:
+                results[name] = scenario()
+                print_result(name, results[name])
+        return results
+
+
+REQUEST_SCENARIOS = ['dashboard', 'dashboard_cold', 'metrics', 'password_reset', 'database']
+JOB_SCENARIOS = ['bulk_sync', 'bulk_sync_full', 'monthly_reset', 'usage_refresh']
+
+
+def print_result(name: str, result: dict) -> None:
+    latency = result['latency_ms']
+    calls = sum(result['marzban_calls'].values())
+    throughput = result.get('throughput_users_per_s')
+    rate = f"{throughput:>9} users/s" if throughput is not None else f"{result['throughput_rps']:>9} req/s  "
+    print(
+        f"{name:<24} p50 {latency['p50']:>9} ms  p99 {latency['p99']:>9} ms  {rate}"
+        f"  errors {result['errors']:>4}  marzban calls {calls}"
+    )
+
+
+def compare(results: dict, baseline: dict, max_regression: float | None) -> bool:
+    """
+    Print p99 and throughput changes against a baseline; return False on a regression
+    beyond `max_regression` percent.
+    """
+    ok = True
+    print(f"\ncompared with {baseline['meta'].get('commit') or 'baseline'}:")
+    for name, result in results.items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for label, key, higher_is_better in (
+            ('p99', lambda r: r['latency_ms']['p99'], False),
+            ('throughput', lambda r: r.get('throughput_users_per_s') or r['throughput_rps'], True),
+        ):
+            old, new = key(before), key(result)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            regression = -change if higher_is_better else change
+            flag = ''
+            if max_regression is not None and regression > max_regression:
+                flag, ok = ' REGRESSION', False
+            changes.append(f"{label} {change:+.1f}%{flag}")
+        print(f"  {name:<24} {'  '.join(changes)}")
+    return ok
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).resolve().parent, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def setup_django(fake: FakeMarzban, database_dir: str) -> None:
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ['DATABASE_DIR'] = database_dir
+    os.environ['MARZBAN_BASE_URL'] = fake.base_url
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+
+    import django
+
+    django.setup()
+
+
+def get_database_profile() -> dict:
+    from django.db import connection
+
+    profile = {
+        'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+        'conn_health_checks': connection.settings_dict['CONN_HEALTH_CHECKS'],
+    }
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size'):
+                profile[pragma] = cursor.execute(f'PRAGMA {pragma}').fetchone()[0]
+    return profile
+
+
+def csv_of(cast: Callable):
+    return lambda value: [cast(item) for item in value.split(',') if item]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--scenarios',
+        type=csv_of(str),
+        default=REQUEST_SCENARIOS + JOB_SCENARIOS,
+        help=f"Comma separated, any of {', '.join(REQUEST_SCENARIOS + JOB_SCENARIOS)}.",
+    )
+    parser.add_argument('--users', type=int, default=500, help="Users in Marzban and in the database.")
+    parser.add_argument('--requests', type=int, default=500, help="Requests per request scenario.")
+    parser.add_argument('--concurrency', type=csv_of(int), default=[1, 10], help="Comma separated.")
+    parser.add_argument('--rounds', type=int, default=3, help="Runs of each job scenario.")
+    parser.add_argument('--drift', type=float, default=0.1, help="Share of users bulk_sync has to fix.")
+    parser.add_argument(
+        '--write-ratio', type=float, default=0.2, help="Share of database operations that write."
+    )
+    parser.add_argument('--latency-ms', type=float, default=5.0, help="Marzban response time.")
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of Marzban calls that fail.")
+    parser.add_argument('--output', type=Path, help="Defaults to benchmarks/results/<timestamp>.json.")
+    parser.add_argument('--baseline', type=Path, help="Earlier result file to compare with.")
+    parser.add_argument('--max-regression', type=float, help="Fail on a p99/throughput regression, in %%.")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(REQUEST_SCENARIOS + JOB_SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    fake = FakeMarzban(
+        users=args.users,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+    ).start()
+
+    with tempfile.TemporaryDirectory(prefix='net-benchmark-') as database_dir:
+        setup_django(fake, database_dir)
+        bench = Bench(fake, args)
+        bench.setup_database()
+        database_profile = get_database_profile()
+        try:
+            results = bench.run()
+        finally:
+            fake.stop()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'database': database_profile,
+            'args': {
+                key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()
+            },
+        },
+        'scenarios': results,
+    }
+    output = args.output or RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nresults written to {output}")
+
+    if args.baseline:
+        if not compare(results, json.loads(args.baseline.read_text()), args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""
+Django settings for the benchmark suite.
+
+`benchmarks.run` fills the required environment (database directory, Marzban URL, ...)
+before Django is set up; everything else is the production configuration.
+"""
+from net.settings import *  # noqa: F401,F403
+
+ALLOWED_HOSTS = ['testserver', 'localhost']
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'root': {'level': 'ERROR'},
+    # Failed requests are counted by the benchmark; their tracebacks would drown the report.
+    'loggers': {'django.request': {'level': 'CRITICAL'}},
+}
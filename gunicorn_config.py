@@ -1,29 +1,172 @@
+import os
+import shutil
+
+from decouple import config
+
+_prometheus_multiproc_dir = config("PROMETHEUS_MULTIPROC_DIR", default="")
+
+
+def on_starting(server):
+    # Metric files left by the workers of a previous run would be merged into this one.
+    if _prometheus_multiproc_dir:
+        shutil.rmtree(_prometheus_multiproc_dir, ignore_errors=True)
+        os.makedirs(_prometheus_multiproc_dir)
+
+
 def post_worker_init(worker):
+    from datetime import timedelta
+
+    from apscheduler.executors.pool import ThreadPoolExecutor
     from apscheduler.schedulers.background import BackgroundScheduler
     from apscheduler.triggers.interval import IntervalTrigger
 
-    from accounts.jobs import rest_usage
+    from django.conf import settings
+    from django.utils import timezone
+
+    from accounts.jobs import (
+        drain_outbox,
+        purge_traffic_reset_logs,
+        refresh_metrics,
+        refresh_user_snapshot,
+        rest_usage,
+        rollup_usage,
+        run_background_jobs,
+        send_emails,
+        send_quota_alerts,
+        store_usage,
+        sync_on_startup,
+    )
+    from accounts.leader import LeaderLease, leader_only
+    from accounts.scheduling import PersianMonthTrigger
+    from accounts.startup import startup_tasks
 
     scheduler = BackgroundScheduler()
-    scheduler.add_job(rest_usage, trigger=IntervalTrigger(minutes=1), max_instances=1, coalesce=True)
-    scheduler.start()
 
-    worker.scheduler = scheduler
+    # Nothing below blocks the worker: startup work runs as background jobs and is
+    # listed, for information only, in the readiness probe (/web/ready/).
+    startup_tasks.add(
+        scheduler, 'user_snapshot', refresh_user_snapshot, retry_interval=settings.STARTUP_TASK_RETRY_INTERVAL
+    )
 
-    from django.conf import settings
+    def on_elected():
+        startup_tasks.add(
+            scheduler, 'xray_sync', sync_on_startup, retry_interval=settings.STARTUP_TASK_RETRY_INTERVAL
+        )
+        # Long-interval jobs would otherwise first run a whole interval after a restart
+        # or failover; the new leader runs them right away.
+        for job_id in ('purge_traffic_reset_logs', 'rollup_usage'):
+            scheduler.modify_job(job_id, next_run_time=timezone.now())
 
-    from accounts.services import sync_traffic_limit
-    from accounts.xray_service import update_remarks
+    # Jobs that write to Marzban or the database run only in the process holding the
+    # lease; per-process caches (user snapshot, metrics) are refreshed everywhere.
+    lease = LeaderLease(
+        name='scheduler',
+        ttl=timedelta(seconds=settings.SCHEDULER_LEASE_TTL),
+        on_elected=on_elected,
+    )
+    # Renewal gets its own thread: behind long jobs on the default pool, or dropped as
+    # a misfire, it would let the lease lapse while this process still runs leader jobs.
+    scheduler.add_executor(ThreadPoolExecutor(max_workers=1), alias='lease')
+    scheduler.add_job(
+        lease.try_acquire,
+        trigger=IntervalTrigger(seconds=settings.SCHEDULER_LEASE_TTL / 3),
+        next_run_time=timezone.now(),
+        executor='lease',
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=None,
+    )
+    scheduler.add_job(
+        leader_only(lease, rest_usage),
+        trigger=PersianMonthTrigger(retry_interval=timedelta(seconds=settings.USAGE_RESET_RETRY_INTERVAL)),
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=None,
+    )
+    scheduler.add_job(
+        leader_only(lease, purge_traffic_reset_logs),
+        trigger=IntervalTrigger(days=1),
+        id='purge_traffic_reset_logs',
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        refresh_user_snapshot,
+        trigger=IntervalTrigger(seconds=settings.XRAY_USER_SNAPSHOT_TTL),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        leader_only(lease, store_usage),
+        trigger=IntervalTrigger(seconds=settings.XRAY_USAGE_REFRESH_INTERVAL),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        leader_only(lease, rollup_usage),
+        trigger=IntervalTrigger(hours=1),
+        id='rollup_usage',
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        leader_only(lease, send_quota_alerts),
+        trigger=IntervalTrigger(seconds=settings.QUOTA_ALERT_INTERVAL),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        refresh_metrics,
+        trigger=IntervalTrigger(seconds=settings.METRICS_SAMPLE_INTERVAL),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        leader_only(lease, drain_outbox),
+        trigger=IntervalTrigger(seconds=settings.XRAY_OUTBOX_POLL_INTERVAL),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        leader_only(lease, send_emails),
+        trigger=IntervalTrigger(seconds=settings.EMAIL_OUTBOX_POLL_INTERVAL),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        leader_only(lease, run_background_jobs),
+        trigger=IntervalTrigger(seconds=settings.BULK_JOB_POLL_INTERVAL),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.start()
 
-    sync_traffic_limit()
-    update_remarks(settings.XRAY_REMARK)
+    worker.scheduler = scheduler
+    worker.lease = lease
 
 
 def worker_exit(server, worker):
     if hasattr(worker, "scheduler"):
         worker.scheduler.shutdown()
+    if hasattr(worker, "lease"):
+        worker.lease.release()
 
 
-workers = 1
-threads = 100
+def child_exit(server, worker):
+    if _prometheus_multiproc_dir:
+        from prometheus_client import multiprocess
+
+        # Drops the in-flight gauge of the dead worker; its counters are kept.
+        multiprocess.mark_process_dead(worker.pid, path=_prometheus_multiproc_dir)
+
+
+# Every worker runs its own scheduler, snapshot refresh and system metrics sampling, so
+# Marzban load grows with the worker count; raise it explicitly.
+workers = config("GUNICORN_WORKERS", cast=int, default=1)
+threads = config("GUNICORN_THREADS", cast=int, default=100)
 wsgi_app = "net.wsgi:application"
+
+# Read the same way as settings.ASGI, which mounts the async views.
+if config("ASGI", cast=bool, default=False):
+    worker_class = "uvicorn.workers.UvicornWorker"
+    wsgi_app = "net.asgi:application"
@@ -1,6 +1,8 @@
+import os
 from pathlib import Path
 
 from decouple import Csv, config
+from django.core.exceptions import ImproperlyConfigured
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -27,6 +29,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'accounts.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -59,12 +62,69 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'net.wsgi.application'
 
+# Serve through net.asgi with the async variants of the Marzban-bound views.
+ASGI = config("ASGI", cast=bool, default=False)
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': Path(config('DATABASE_DIR')) / 'db.sqlite3',
+        # Keep one connection per thread instead of reconnecting on every request.
+        'CONN_MAX_AGE': config("DATABASE_CONN_MAX_AGE", cast=int, default=600),
+        'CONN_HEALTH_CHECKS': config("DATABASE_CONN_HEALTH_CHECKS", cast=bool, default=True),
+    }
+}
+
+_CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+}
+# Gunicorn worker processes, see gunicorn_config.py.
+WORKERS = config("GUNICORN_WORKERS", cast=int, default=1)
+
+# Backs sessions, the cached request.user lookup and the snapshot invalidation markers.
+# "locmem" is private to one process, so it is the default for a single worker only;
+# several workers need "redis" (CACHE_LOCATION=redis://...). "file" is shared by the
+# workers of one host, but every write lists the cache directory to cull it, so writes
+# cost O(entries): keep CACHE_MAX_ENTRIES small with it.
+CACHE_BACKEND = config("CACHE_BACKEND", default="locmem" if WORKERS == 1 else "redis")
+if CACHE_BACKEND == 'locmem' and WORKERS > 1:
+    raise ImproperlyConfigured("CACHE_BACKEND=locmem is private to one process, use redis with workers > 1")
+CACHES = {
+    'default': {
+        'BACKEND': _CACHE_BACKENDS[CACHE_BACKEND],
+        'LOCATION': config(
+            "CACHE_LOCATION",
+            default=str(Path(config('DATABASE_DIR')) / 'cache') if CACHE_BACKEND == 'file' else '',
+        ),
     }
 }
+if CACHE_BACKEND == 'redis' and not CACHES['default']['LOCATION']:
+    raise ImproperlyConfigured("CACHE_BACKEND=redis needs CACHE_LOCATION=redis://...")
+if CACHE_BACKEND != 'redis':
+    # Django's default of 300 entries is far below one session, user and snapshot key per
+    # user, so the cache would cull constantly. When full, 1/CULL_FREQUENCY of it is dropped.
+    CACHES['default']['OPTIONS'] = {
+        'MAX_ENTRIES': config(
+            "CACHE_MAX_ENTRIES", cast=int, default=50000 if CACHE_BACKEND == 'locmem' else 2000
+        ),
+        'CULL_FREQUENCY': config("CACHE_CULL_FREQUENCY", cast=int, default=10),
+    }
+
+# "db", "cached_db" (read through the cache, written to both) or "cache" (cache only).
+SESSION_ENGINE = f'django.contrib.sessions.backends.{config("SESSION_BACKEND", default="cached_db")}'
+
+AUTHENTICATION_BACKENDS = ['accounts.backends.CachedModelBackend']
+USER_CACHE_TIMEOUT = config("USER_CACHE_TIMEOUT", cast=int, default=300)
+
+# Pragmas applied to every SQLite connection, see accounts.db.configure_sqlite.
+SQLITE_JOURNAL_MODE = config("SQLITE_JOURNAL_MODE", default="WAL")
+SQLITE_SYNCHRONOUS = config("SQLITE_SYNCHRONOUS", default="NORMAL")
+SQLITE_BUSY_TIMEOUT = config("SQLITE_BUSY_TIMEOUT", cast=int, default=5000)  # milliseconds
+SQLITE_MMAP_SIZE = config("SQLITE_MMAP_SIZE", cast=int, default=256 * 1024 * 1024)
+# Negative values are KiB, positive values pages.
+SQLITE_CACHE_SIZE = config("SQLITE_CACHE_SIZE", cast=int, default=-64000)
 
 LANGUAGE_CODE = 'en-us'
 
@@ -87,6 +147,18 @@ EMAIL_PORT = config("EMAIL_PORT", cast=int)
 EMAIL_USE_TLS = config("EMAIL_USE_TLS", cast=bool, default=True)
 DEFAULT_FROM_EMAIL = config("DEFAULT_FROM_EMAIL")
 PASSWORD_RESET_SUBJECT = config("PASSWORD_RESET_SUBJECT")
+# Lifetime of password reset links; queued reset emails are dropped once it passes.
+PASSWORD_RESET_TOKEN_TTL = config("PASSWORD_RESET_TOKEN_TTL", cast=int, default=300)
+QUOTA_ALERT_SUBJECT = config("QUOTA_ALERT_SUBJECT", default="Traffic quota alert")
+# Emails are queued and sent in the background over one SMTP connection per run, in
+# batches of EMAIL_OUTBOX_BATCH_SIZE and on average at most EMAIL_OUTBOX_RATE_LIMIT
+# messages per second (0 for no limit).
+EMAIL_OUTBOX_POLL_INTERVAL = config("EMAIL_OUTBOX_POLL_INTERVAL", cast=int, default=5)
+EMAIL_OUTBOX_BATCH_SIZE = config("EMAIL_OUTBOX_BATCH_SIZE", cast=int, default=100)
+EMAIL_OUTBOX_RATE_LIMIT = config("EMAIL_OUTBOX_RATE_LIMIT", cast=float, default=10.0)
+EMAIL_OUTBOX_MAX_ATTEMPTS = config("EMAIL_OUTBOX_MAX_ATTEMPTS", cast=int, default=8)
+EMAIL_OUTBOX_RETRY_BASE_DELAY = config("EMAIL_OUTBOX_RETRY_BASE_DELAY", cast=int, default=30)
+EMAIL_OUTBOX_RETRY_MAX_DELAY = config("EMAIL_OUTBOX_RETRY_MAX_DELAY", cast=int, default=3600)
 
 WEB_BASE_URL = config("WEB_BASE_URL")
 
@@ -94,6 +166,57 @@ MARZBAN_ACCESS_TOKEN = config("MARZBAN_ACCESS_TOKEN")
 MARZBAN_BASE_URL = config("MARZBAN_BASE_URL")
 MONTHLY_TRAFFIC_LIMIT_BYTES = config("MONTHLY_TRAFFIC_LIMIT_BYTES", cast=int)
 
+XRAY_CONNECT_TIMEOUT = config("XRAY_CONNECT_TIMEOUT", cast=float, default=3.05)
+XRAY_READ_TIMEOUT = config("XRAY_READ_TIMEOUT", cast=float, default=10.0)
+# Sized to the gunicorn thread count so request threads never queue on the pool.
+XRAY_POOL_MAXSIZE = config("XRAY_POOL_MAXSIZE", cast=int, default=config("GUNICORN_THREADS", default="100"))
+XRAY_RETRY_TOTAL = config("XRAY_RETRY_TOTAL", cast=int, default=2)
+XRAY_RETRY_BACKOFF_FACTOR = config("XRAY_RETRY_BACKOFF_FACTOR", cast=float, default=0.3)
+XRAY_CIRCUIT_FAILURE_THRESHOLD = config("XRAY_CIRCUIT_FAILURE_THRESHOLD", cast=int, default=5)
+XRAY_CIRCUIT_RESET_TIMEOUT = config("XRAY_CIRCUIT_RESET_TIMEOUT", cast=float, default=30.0)
+
+XRAY_USER_LIST_PAGE_SIZE = config("XRAY_USER_LIST_PAGE_SIZE", cast=int, default=500)
+XRAY_USER_SNAPSHOT_TTL = config("XRAY_USER_SNAPSHOT_TTL", cast=int, default=60)
+XRAY_USER_SNAPSHOT_MAX_STALENESS = config("XRAY_USER_SNAPSHOT_MAX_STALENESS", cast=int, default=300)
+# How often the leader copies the snapshot into the usage table the admin lists.
+XRAY_USAGE_REFRESH_INTERVAL = config("XRAY_USAGE_REFRESH_INTERVAL", cast=int, default=60)
+# Raw usage samples are rolled into hourly rows every hour and complete days of those
+# into daily rows; hourly and daily rows are kept for these many days.
+USAGE_HISTORY_HOURLY_RETENTION_DAYS = config("USAGE_HISTORY_HOURLY_RETENTION_DAYS", cast=int, default=7)
+USAGE_HISTORY_DAILY_RETENTION_DAYS = config("USAGE_HISTORY_DAILY_RETENTION_DAYS", cast=int, default=400)
+USAGE_HISTORY_DAYS_SHOWN = config("USAGE_HISTORY_DAYS_SHOWN", cast=int, default=30)
+# Quota alerts for users without a traffic policy, and how often they are evaluated.
+QUOTA_ALERT_THRESHOLDS = config("QUOTA_ALERT_THRESHOLDS", default="80,95,100")
+QUOTA_ALERT_INTERVAL = config("QUOTA_ALERT_INTERVAL", cast=int, default=300)
+XRAY_BULK_PARALLELISM = config("XRAY_BULK_PARALLELISM", cast=int, default=10)
+
+XRAY_OUTBOX_POLL_INTERVAL = config("XRAY_OUTBOX_POLL_INTERVAL", cast=int, default=5)
+XRAY_OUTBOX_BATCH_SIZE = config("XRAY_OUTBOX_BATCH_SIZE", cast=int, default=500)
+XRAY_OUTBOX_RETRY_BASE_DELAY = config("XRAY_OUTBOX_RETRY_BASE_DELAY", cast=int, default=10)
+XRAY_OUTBOX_RETRY_MAX_DELAY = config("XRAY_OUTBOX_RETRY_MAX_DELAY", cast=int, default=3600)
+
+USAGE_RESET_CHUNK_SIZE = config("USAGE_RESET_CHUNK_SIZE", cast=int, default=200)
+USAGE_RESET_RETRY_INTERVAL = config("USAGE_RESET_RETRY_INTERVAL", cast=int, default=300)
+
+# Reset logs older than this are purged daily; 0 keeps them forever. With an archive
+# directory they are written there as gzipped JSON lines before being deleted.
+TRAFFIC_RESET_LOG_RETENTION_DAYS = config("TRAFFIC_RESET_LOG_RETENTION_DAYS", cast=int, default=400)
+TRAFFIC_RESET_LOG_ARCHIVE_DIR = config("TRAFFIC_RESET_LOG_ARCHIVE_DIR", default="")
+TRAFFIC_RESET_LOG_PURGE_BATCH_SIZE = config("TRAFFIC_RESET_LOG_PURGE_BATCH_SIZE", cast=int, default=1000)
+
+SCHEDULER_LEASE_TTL = config("SCHEDULER_LEASE_TTL", cast=int, default=30)
+
+STARTUP_TASK_RETRY_INTERVAL = config("STARTUP_TASK_RETRY_INTERVAL", cast=int, default=60)
+
+BULK_JOB_POLL_INTERVAL = config("BULK_JOB_POLL_INTERVAL", cast=int, default=5)
+BULK_JOB_CHUNK_SIZE = config("BULK_JOB_CHUNK_SIZE", cast=int, default=200)
+
+XRAY_ASYNC_MAX_CONNECTIONS = config("XRAY_ASYNC_MAX_CONNECTIONS", cast=int, default=100)
+XRAY_ASYNC_MAX_KEEPALIVE_CONNECTIONS = config("XRAY_ASYNC_MAX_KEEPALIVE_CONNECTIONS", cast=int, default=20)
+XRAY_ASYNC_KEEPALIVE_EXPIRY = config("XRAY_ASYNC_KEEPALIVE_EXPIRY", cast=float, default=30.0)
+XRAY_ASYNC_TIMEOUT = config("XRAY_ASYNC_TIMEOUT", cast=float, default=10.0)
+XRAY_ASYNC_HTTP2 = config("XRAY_ASYNC_HTTP2", cast=bool, default=True)
+
 LOGIN_URL = "login"
 
 XRAY_REMARK = config("XRAY_REMARK", default="Server")
@@ -103,3 +226,20 @@ XRAY_SERVER_CERTIFICATE_FILE = config("XRAY_SERVER_CERTIFICATE_FILE", default=No
 METRICS_NAMESPACE = config("METRICS_NAMESPACE", default="xray")
 
 METRICS_ACCESS_TOKEN = config("METRICS_ACCESS_TOKEN", default=None)
+
+METRICS_SAMPLE_INTERVAL = config("METRICS_SAMPLE_INTERVAL", cast=int, default=15)
+METRICS_MAX_AGE = config("METRICS_MAX_AGE", cast=float, default=30.0)
+METRICS_USER_MODE = config("METRICS_USER_MODE", default="top")
+METRICS_USER_TOP_N = config("METRICS_USER_TOP_N", cast=int, default=100)
+# Counters and histograms are kept per worker process. With several workers, point this
+# at an empty directory so they are shared through files there and merged on scrape;
+# otherwise each scrape only sees the worker that answered it.
+PROMETHEUS_MULTIPROC_DIR = config("PROMETHEUS_MULTIPROC_DIR", default="")
+if PROMETHEUS_MULTIPROC_DIR:
+    # prometheus_client reads it from the environment when it is first imported.
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', PROMETHEUS_MULTIPROC_DIR)
+
+# Send the per-request time breakdown in a Server-Timing header.
+REQUEST_TIMING_HEADER = config("REQUEST_TIMING_HEADER", cast=bool, default=True)
+# Log requests slower than this many seconds with their breakdown; 0 disables it.
+REQUEST_SLOW_THRESHOLD = config("REQUEST_SLOW_THRESHOLD", cast=float, default=1.0)